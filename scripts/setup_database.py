@@ -4,12 +4,11 @@ import os
 # Add src directory to Python path to allow importing modules from src
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from src.database import get_db_connection, create_tables
+from src.database import get_db_connection, create_tables, close_db_connections
 from loguru import logger
 
 def main():
     logger.info("Setting up database...")
-    conn = None
     try:
         conn = get_db_connection()
         create_tables(conn)
@@ -17,9 +16,7 @@ def main():
     except Exception as e:
         logger.error(f"Database setup failed: {e}")
     finally:
-        if conn:
-            conn.close()
-            logger.info("Database connection closed.")
+        close_db_connections()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
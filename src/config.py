@@ -1,62 +1,163 @@
 import os
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 from loguru import logger
 
-# Load .env only for local development, not needed in Cloud Run
-if os.getenv("GOOGLE_CLOUD_RUN_JOB") is None: # Simple check if not in Cloud Run
-     from dotenv import load_dotenv
-     env_path = Path('.') / '.env'
-     if env_path.exists():
-         load_dotenv(dotenv_path=env_path)
-     else:
-         logger.warning(".env file not found for local development.")
 
+@dataclass(frozen=True)
+class Config:
+    """Fully-resolved runtime configuration, built once per process by get_config()."""
+    # Reddit Config
+    reddit_client_id: Optional[str]
+    reddit_client_secret: Optional[str]
+    reddit_user_agent: str
+    # LLM Config
+    openai_api_key: Optional[str]
+    # Project Settings
+    subreddit_name: str
+    post_limit: int
+    similarity_model: str
+    similarity_int8: bool
+    log_level: str
+    # Local SQLite database (scripts/setup_database.py, notebooks)
+    database_path: str
+    # SQLite file holding cached sentence embeddings ("" disables the cache)
+    embedding_cache_path: str
+    # Cloud SQL Configuration
+    db_user: Optional[str]
+    db_pass: Optional[str]
+    db_name: Optional[str]
+    instance_connection_name: Optional[str] # 'project:region:instance-id'
+    db_driver: str # Choose the DB driver dialect based on installation in pyproject.toml
+    enable_iam_auth: bool
+    db_pool_size: int
+    db_max_overflow: int
+
+
+# Probe for .env once per process (never in Cloud Run, where it is not used)
+_ENV_PATH = Path('.') / '.env'
+_ENV_EXISTS = "GOOGLE_CLOUD_RUN_JOB" not in os.environ and _ENV_PATH.is_file()
+
+
+@lru_cache(maxsize=1)
+def _load_dotenv_file(mtime_ns: int):
+    """Parses .env; keyed on its mtime so a config reload only re-parses a changed file."""
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=_ENV_PATH)
+
+
+def _load_local_env():
+    """Loads .env for local development; not needed in Cloud Run."""
+    if _ENV_EXISTS:
+        _load_dotenv_file(_ENV_PATH.stat().st_mtime_ns)
+    else:
+        logger.warning(".env file not found for local development.")
+
+
+def _validate(cfg: Config):
+    """Logs missing credentials/config; does not raise so local tooling still imports."""
+    missing_creds = []
+    if not cfg.reddit_client_id: missing_creds.append("REDDIT_CLIENT_ID")
+    if not cfg.reddit_client_secret: missing_creds.append("REDDIT_CLIENT_SECRET")
+    if not cfg.openai_api_key: missing_creds.append("OPENAI_API_KEY")
+    if missing_creds:
+        logger.error(f"Missing required API credentials in environment variables: {', '.join(missing_creds)}")
+        # raise ValueError(f"Missing required API credentials: {', '.join(missing_creds)}")
+
+    missing_db_config = []
+    if not cfg.db_user: missing_db_config.append("DB_USER")
+    if not cfg.db_pass: missing_db_config.append("DB_PASS")
+    if not cfg.db_name: missing_db_config.append("DB_NAME")
+    if not cfg.instance_connection_name: missing_db_config.append("INSTANCE_CONNECTION_NAME")
+    if missing_db_config:
+        logger.error(f"Missing database configuration in environment variables: {', '.join(missing_db_config)}")
+        # raise ValueError(f"Missing database configuration: {', '.join(missing_db_config)}")
+
+
+def _build_config(env, in_cloud_run: bool) -> Config:
+    """Builds a Config from a single snapshot of the environment."""
+    return Config(
+        reddit_client_id=env.get("REDDIT_CLIENT_ID"),
+        reddit_client_secret=env.get("REDDIT_CLIENT_SECRET"),
+        reddit_user_agent=env.get("REDDIT_USER_AGENT", "llm_desabafos_analyzer_cloud_run"),
+        openai_api_key=env.get("OPENAI_API_KEY"),
+        subreddit_name=env.get("SUBREDDIT_NAME", "desabafos"),
+        post_limit=int(env.get("POST_LIMIT", "50")),
+        similarity_model=env.get("SIMILARITY_MODEL", "all-MiniLM-L6-v2"),
+        # Opt-in int8 quantization of the encoder on CPU: faster, but shifts similarity scores
+        similarity_int8=env.get("SIMILARITY_INT8", "false").lower() == "true",
+        log_level=env.get("LOG_LEVEL", "INFO"),
+        database_path=env.get("DATABASE_PATH", "data/desabafos_data.db"),
+        # The cache only pays off where the file outlives the process. Cloud Run discards
+        # the container filesystem after each job, so there it is off unless pointed at a
+        # mounted volume; locally it shares the SQLite database by default.
+        embedding_cache_path=env.get(
+            "EMBEDDING_CACHE_PATH", "" if in_cloud_run else env.get("DATABASE_PATH", "data/desabafos_data.db")
+        ),
+        db_user=env.get("DB_USER"),
+        db_pass=env.get("DB_PASS"),
+        db_name=env.get("DB_NAME"),
+        instance_connection_name=env.get("INSTANCE_CONNECTION_NAME"),
+        # DB_DRIVER = "postgresql+psycopg2"
+        db_driver=env.get("DB_DRIVER", "postgresql+psycopg2"), # Or postgresql+pg8000
+        # Use IAM AuthN by default if available and running in Cloud Run
+        enable_iam_auth=env.get("DB_ENABLE_IAM_AUTH", "true").lower() == "true" and in_cloud_run,
+        # SQLAlchemy pool sizing (raise along with pipeline concurrency)
+        db_pool_size=int(env.get("DB_POOL_SIZE", "10")),
+        db_max_overflow=int(env.get("DB_MAX_OVERFLOW", "20")),
+    )
+
+
+def _cloud_config() -> Config:
+    """Cloud Run: everything comes from the job's environment variables."""
+    return _build_config(os.environ, in_cloud_run=True)
+
+
+def _local_config() -> Config:
+    """Local development: environment variables, optionally seeded from .env."""
+    _load_local_env()
+    return _build_config(os.environ, in_cloud_run=False)
+
+
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Resolves the configuration exactly once per process and returns it."""
+    cfg = _cloud_config() if "GOOGLE_CLOUD_RUN_JOB" in os.environ else _local_config()
+    _validate(cfg)
+    return cfg
+
+
+# --- Module-level names (kept for existing `config.X` consumers) ---
+_config = get_config()
 
 # Reddit Config
-REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
-REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
-REDDIT_USER_AGENT = os.getenv("REDDIT_USER_AGENT", "llm_desabafos_analyzer_cloud_run")
+REDDIT_CLIENT_ID = _config.reddit_client_id
+REDDIT_CLIENT_SECRET = _config.reddit_client_secret
+REDDIT_USER_AGENT = _config.reddit_user_agent
 
 # LLM Config
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_API_KEY = _config.openai_api_key
 
 # Project Settings
-SUBREDDIT_NAME = os.getenv("SUBREDDIT_NAME", "desabafos")
-POST_LIMIT = int(os.getenv("POST_LIMIT", "50"))
-SIMILARITY_MODEL = os.getenv("SIMILARITY_MODEL", "all-MiniLM-L6-v2")
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+SUBREDDIT_NAME = _config.subreddit_name
+POST_LIMIT = _config.post_limit
+SIMILARITY_MODEL = _config.similarity_model
+SIMILARITY_INT8 = _config.similarity_int8
+LOG_LEVEL = _config.log_level
+DATABASE_PATH = _config.database_path
+EMBEDDING_CACHE_PATH = _config.embedding_cache_path
 
 # --- Cloud SQL Configuration ---
-DB_USER = os.getenv("DB_USER")
-DB_PASS = os.getenv("DB_PASS")
-DB_NAME = os.getenv("DB_NAME")
-# Instance Connection Name: 'project:region:instance-id'
-INSTANCE_CONNECTION_NAME = os.getenv("INSTANCE_CONNECTION_NAME")
-# Choose the DB driver dialect based on installation in pyproject.toml
-# DB_DRIVER = "postgresql+psycopg2"
-DB_DRIVER = os.getenv("DB_DRIVER", "postgresql+psycopg2") # Or postgresql+pg8000
-
-# --- Basic Validation ---
-missing_creds = []
-if not REDDIT_CLIENT_ID: missing_creds.append("REDDIT_CLIENT_ID")
-if not REDDIT_CLIENT_SECRET: missing_creds.append("REDDIT_CLIENT_SECRET")
-if not OPENAI_API_KEY: missing_creds.append("OPENAI_API_KEY")
-if missing_creds:
-    logger.error(f"Missing required API credentials in environment variables: {', '.join(missing_creds)}")
-    # raise ValueError(f"Missing required API credentials: {', '.join(missing_creds)}")
-
-missing_db_config = []
-if not DB_USER: missing_db_config.append("DB_USER")
-if not DB_PASS: missing_db_config.append("DB_PASS")
-if not DB_NAME: missing_db_config.append("DB_NAME")
-if not INSTANCE_CONNECTION_NAME: missing_db_config.append("INSTANCE_CONNECTION_NAME")
-if missing_db_config:
-     logger.error(f"Missing database configuration in environment variables: {', '.join(missing_db_config)}")
-     # raise ValueError(f"Missing database configuration: {', '.join(missing_db_config)}")
-
-# Determine if running in Cloud Run for connector settings
-# Use IAM AuthN by default if available and running in Cloud Run
-ENABLE_IAM_AUTH = os.getenv("DB_ENABLE_IAM_AUTH", "true").lower() == "true" and os.getenv("GOOGLE_CLOUD_RUN_JOB") is not None
+DB_USER = _config.db_user
+DB_PASS = _config.db_pass
+DB_NAME = _config.db_name
+INSTANCE_CONNECTION_NAME = _config.instance_connection_name
+DB_DRIVER = _config.db_driver
+ENABLE_IAM_AUTH = _config.enable_iam_auth
+DB_POOL_SIZE = _config.db_pool_size
+DB_MAX_OVERFLOW = _config.db_max_overflow
 
 
 # --- Database URL (Optional, can be constructed if needed elsewhere) ---
@@ -64,4 +165,4 @@ ENABLE_IAM_AUTH = os.getenv("DB_ENABLE_IAM_AUTH", "true").lower() == "true" and
 # if all([DB_USER, DB_PASS, DB_NAME, INSTANCE_CONNECTION_NAME]):
 #     DATABASE_URL = f"{DB_DRIVER}://{DB_USER}:{DB_PASS}@/{DB_NAME}?host=/cloudsql/{INSTANCE_CONNECTION_NAME}"
 # else:
-#     DATABASE_URL = None
\ No newline at end of file
+#     DATABASE_URL = None
@@ -1,90 +1,216 @@
 import sqlite3
+import datetime
+import functools
+import queue
+from contextlib import contextmanager
 from pathlib import Path
 from . import config
 from loguru import logger
-import datetime
 
 DATABASE_FILE = Path(config.DATABASE_PATH)
+
+# is_actual_advice is declared BOOLEAN; read it back as a real bool instead of 0/1.
+# (Writing needs no adapter: sqlite3 already binds bool as INTEGER natively.)
+sqlite3.register_converter("BOOLEAN", lambda value: value == b"1")
+
+
+def _convert_timestamp(value: bytes):
+    """
+    Reads TIMESTAMP columns. Databases created before created_utc became INTEGER still
+    declare it TIMESTAMP and now hold epoch ints next to older ISO strings, which the
+    default converter cannot parse: ints come back as int, ISO strings as datetime.
+    """
+    if value.isdigit():
+        return int(value)
+    return datetime.datetime.fromisoformat(value.decode())
+
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
 # TABLES CREATED:
 # - processed_posts
 # - llm_data
 # - post_comments (new table for top comments)
 
+# --- Statements shared by the single-row and bulk helpers (reused from sqlite3's statement cache) ---
+_SQL_CHECK_POST = "SELECT 1 FROM processed_posts WHERE post_id = ?"
+_SQL_INSERT_PROCESSED_POST = """
+    INSERT INTO processed_posts (
+        post_id, post_url, post_title, post_body, created_utc
+    ) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(post_id) DO NOTHING;
+"""
+_SQL_INSERT_LLM_DATA = """
+    INSERT INTO llm_data (
+        post_id, input_prompt, llm_response
+    ) VALUES (?, ?, ?)
+    ON CONFLICT(post_id) DO UPDATE SET
+        input_prompt = excluded.input_prompt,
+        llm_response = excluded.llm_response,
+        created_at = CURRENT_TIMESTAMP;
+"""
+_SQL_INSERT_COMMENT = """
+    INSERT INTO post_comments (
+        post_id, comment_id, comment_body, comment_score, comment_rank,
+        is_actual_advice, similarity_score
+    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(comment_id) DO UPDATE SET
+        comment_score = excluded.comment_score,
+        is_actual_advice = excluded.is_actual_advice,
+        similarity_score = excluded.similarity_score,
+        fetched_at = CURRENT_TIMESTAMP;
+        -- Note: We generally don't update rank or body on conflict
+"""
+
+# WAL mode is persistent in the database file, so it only needs to be set once per process
+_wal_enabled = False
+# The data directory only needs to be created once per process
+_dir_ready = False
+
+def _ensure_dir():
+    """Creates the database directory on first use instead of on every connection open."""
+    global _dir_ready
+    if _dir_ready:
+        return
+    DATABASE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    _dir_ready = True
 
-def get_db_connection():
-    """Establishes a connection to the SQLite database."""
+def _apply_pragmas(conn: sqlite3.Connection, read_only: bool = False):
+    """Tunes the connection for the insert-heavy pipeline workload."""
+    global _wal_enabled
+    if not _wal_enabled and not read_only:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        _wal_enabled = True
+    if not read_only:
+        conn.execute("PRAGMA synchronous=NORMAL;") # Safe with WAL; fsync only at checkpoints
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-64000;") # ~64MB page cache
+    conn.execute("PRAGMA mmap_size=268435456;") # 256MB memory-mapped I/O
+    conn.execute("PRAGMA foreign_keys = ON;")
+
+def _open_connection(read_only: bool = False, check_same_thread: bool = True) -> sqlite3.Connection:
+    """Opens and configures a new SQLite connection."""
     try:
-        DATABASE_FILE.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(DATABASE_FILE, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        _ensure_dir()
+        if read_only:
+            target, uri = f"{DATABASE_FILE.resolve().as_uri()}?mode=ro", True
+        else:
+            target, uri = DATABASE_FILE, False
+        conn = sqlite3.connect(
+            target,
+            uri=uri,
+            detect_types=sqlite3.PARSE_DECLTYPES, # No "col [type]" aliases are used, so skip PARSE_COLNAMES
+            check_same_thread=check_same_thread,
+            cached_statements=256,
+        )
         conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys = ON;")
-        logger.info(f"Database connection established: {DATABASE_FILE}")
+        _apply_pragmas(conn, read_only=read_only)
+        logger.info(f"Database connection established: {DATABASE_FILE}{' (read-only)' if read_only else ''}")
         return conn
     except sqlite3.Error as e:
         logger.error(f"Error connecting to database: {e}")
         raise
 
+@functools.lru_cache(maxsize=1)
+def get_db_connection() -> sqlite3.Connection:
+    """Returns the process-wide SQLite connection, opening it on first use."""
+    return _open_connection()
+
+@functools.lru_cache(maxsize=1)
+def get_readonly_connection() -> sqlite3.Connection:
+    """Returns a process-wide read-only connection, e.g. for check_post_processed."""
+    return _open_connection(read_only=True)
+
+# --- Connection pool for multi-threaded callers ---
+_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+
+@contextmanager
+def acquire_connection():
+    """Borrows a pooled connection for use from a worker thread, returning it afterwards."""
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(check_same_thread=False)
+    try:
+        yield conn
+    finally:
+        _pool.put(conn)
+
+def close_db_connections():
+    """Closes the cached and pooled connections."""
+    for getter in (get_db_connection, get_readonly_connection):
+        if getter.cache_info().currsize:
+            getter().close()
+        getter.cache_clear()
+    while not _pool.empty():
+        _pool.get_nowait().close()
+    logger.info("Database connections closed.")
+
+@contextmanager
+def db_transaction(conn: sqlite3.Connection):
+    """
+    Groups several insert_* calls into one transaction, committing once at the end.
+
+    Usage:
+        with db_transaction(conn):
+            for comment in comments:
+                insert_post_comment(conn, comment)
+    """
+    # The connection's own context manager commits on success and rolls back on error in C
+    with conn:
+        yield conn
+
+_SCHEMA_SQL = """
+    -- --- processed_posts table (comment fields removed) ---
+    CREATE TABLE IF NOT EXISTS processed_posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id TEXT UNIQUE NOT NULL,
+        post_url TEXT NOT NULL,
+        post_title TEXT,
+        post_body TEXT,
+        created_utc INTEGER, -- Epoch seconds (UTC); read with datetime(created_utc, 'unixepoch')
+        processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_post_id ON processed_posts (post_id);
+
+    -- --- llm_data table ---
+    CREATE TABLE IF NOT EXISTS llm_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id TEXT NOT NULL, -- Link to the processed post
+        input_prompt TEXT NOT NULL,
+        llm_response TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(post_id), -- Assuming one LLM attempt per post in this table
+        FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
+    );
+    -- llm_data.post_id needs no extra index: UNIQUE(post_id) already creates one
+
+    -- --- post_comments table (top comments) ---
+    CREATE TABLE IF NOT EXISTS post_comments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id TEXT NOT NULL,
+        comment_id TEXT UNIQUE NOT NULL, -- Reddit comment ID
+        comment_body TEXT,
+        comment_score INTEGER,
+        comment_rank INTEGER NOT NULL, -- Rank 1-5 among top comments fetched
+        is_actual_advice BOOLEAN, -- Result of verification LLM call
+        similarity_score REAL, -- Similarity vs main LLM advice (e.g., only for rank 1)
+        fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
+    );
+    -- Add indices for faster querying
+    CREATE INDEX IF NOT EXISTS idx_comment_post_id ON post_comments (post_id);
+    CREATE INDEX IF NOT EXISTS idx_comment_rank ON post_comments (comment_rank);
+    CREATE INDEX IF NOT EXISTS idx_comment_is_advice ON post_comments (is_actual_advice);
+    -- Covering index for "best advice comment per post" lookups
+    CREATE INDEX IF NOT EXISTS idx_comment_post_rank ON post_comments (post_id, comment_rank, is_actual_advice);
+
+    -- Refresh planner statistics only where SQLite considers them stale
+    PRAGMA optimize;
+"""
+
 def create_tables(conn: sqlite3.Connection):
-    """Creates the necessary tables if they don't exist."""
+    """Creates the necessary tables if they don't exist, in a single executescript call."""
     try:
-        cursor = conn.cursor()
-        # --- processed_posts table (comment fields removed) ---
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS processed_posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id TEXT UNIQUE NOT NULL,
-                post_url TEXT NOT NULL,
-                post_title TEXT,
-                post_body TEXT,
-                created_utc TIMESTAMP,
-                processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_post_id ON processed_posts (post_id);
-        """)
-
-        # --- llm_data table (No changes needed here for this request) ---
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS llm_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id TEXT NOT NULL, -- Link to the processed post
-                input_prompt TEXT NOT NULL,
-                llm_response TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(post_id), -- Assuming one LLM attempt per post in this table
-                FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
-            );
-        """)
-
-        # --- post_comments table (New table for top comments) ---
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS post_comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id TEXT NOT NULL,
-                comment_id TEXT UNIQUE NOT NULL, -- Reddit comment ID
-                comment_body TEXT,
-                comment_score INTEGER,
-                comment_rank INTEGER NOT NULL, -- Rank 1-5 among top comments fetched
-                is_actual_advice BOOLEAN, -- Result of verification LLM call
-                similarity_score REAL, -- Similarity vs main LLM advice (e.g., only for rank 1)
-                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
-            );
-        """)
-        # Add indices for faster querying
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_comment_post_id ON post_comments (post_id);
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_comment_rank ON post_comments (comment_rank);
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_comment_is_advice ON post_comments (is_actual_advice);
-        """)
-
-
-        conn.commit()
+        conn.executescript(_SCHEMA_SQL)
         logger.info("Database tables checked/created successfully.")
     except sqlite3.Error as e:
         logger.error(f"Error creating database tables: {e}")
@@ -93,102 +219,126 @@ def create_tables(conn: sqlite3.Connection):
 def check_post_processed(conn: sqlite3.Connection, post_id: str) -> bool:
     """Checks if a post_id already exists in the processed_posts table."""
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM processed_posts WHERE post_id = ?", (post_id,))
-        return cursor.fetchone() is not None
+        return conn.execute(_SQL_CHECK_POST, (post_id,)).fetchone() is not None
     except sqlite3.Error as e:
         logger.error(f"Error checking if post {post_id} is processed: {e}")
         return False
 
+# Stay well below SQLite's bound-parameter limit when building IN (...) lists
+_MAX_IN_PARAMS = 500
+
+def load_processed_ids(conn: sqlite3.Connection) -> set[str]:
+    """Loads every known post_id once, so per-post existence checks become set lookups."""
+    try:
+        return {row[0] for row in conn.execute("SELECT post_id FROM processed_posts")}
+    except sqlite3.Error as e:
+        logger.error(f"Error loading processed post ids: {e}")
+        return set()
+
+def filter_processed_ids(conn: sqlite3.Connection, post_ids: list) -> set[str]:
+    """Returns the subset of post_ids already in processed_posts, using batched IN queries."""
+    processed = set()
+    try:
+        for start in range(0, len(post_ids), _MAX_IN_PARAMS):
+            chunk = post_ids[start:start + _MAX_IN_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = conn.execute(f"SELECT post_id FROM processed_posts WHERE post_id IN ({placeholders})", chunk)
+            processed.update(row[0] for row in cursor)
+    except sqlite3.Error as e:
+        logger.error(f"Error checking processed status for {len(post_ids)} posts: {e}")
+    return processed
+
 # --- insert_processed_post (Updated: comment/similarity fields removed) ---
-def insert_processed_post(conn: sqlite3.Connection, data: dict):
-    """Inserts a processed post record (post-level data only)."""
-    created_utc_val = data.get('created_utc')
-    if created_utc_val and not isinstance(created_utc_val, datetime.datetime):
-         try:
-             if isinstance(created_utc_val, (int, float)):
-                 created_utc_val = datetime.datetime.fromtimestamp(created_utc_val, tz=datetime.timezone.utc)
-             else:
-                 created_utc_val = datetime.datetime.fromisoformat(str(created_utc_val).replace('Z', '+00:00')) # Handle Z notation
-         except ValueError:
-             logger.warning(f"Could not parse created_utc: {created_utc_val}. Setting to None.")
-             created_utc_val = None
+def insert_processed_post(conn: sqlite3.Connection, data: dict) -> bool:
+    """
+    Inserts a processed post record (post-level data only). Does not commit; see db_transaction.
 
+    Returns:
+        True if the post was newly inserted, False if it already existed.
+        A failed insert is logged and re-raised.
+        Callers can gate the LLM work on this instead of a separate check_post_processed query.
+
+    created_utc is expected to be epoch seconds (see reddit_scraper.extract_post_data).
+    """
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO processed_posts (
-                post_id, post_url, post_title, post_body, created_utc
-            ) VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(post_id) DO NOTHING;
-        """, (
+        cursor = conn.execute(_SQL_INSERT_PROCESSED_POST, (
             data.get('post_id'), data.get('post_url'), data.get('post_title'),
-            data.get('post_body'), created_utc_val
+            data.get('post_body'), data.get('created_utc')
         ))
-        conn.commit()
         if cursor.rowcount > 0:
-            logger.info(f"Inserted record into processed_posts for post_id: {data.get('post_id')}")
-        else:
-             logger.warning(f"processed_posts record for post_id: {data.get('post_id')} likely already existed. No insert performed.")
+            logger.debug("Inserted record into processed_posts for post_id: {}", data.get('post_id'))
+            return True
+        logger.debug("processed_posts record for post_id: {} already existed. No insert performed.", data.get('post_id'))
     except sqlite3.IntegrityError as ie:
          logger.warning(f"Integrity Error inserting into processed_posts for post {data.get('post_id')}: {ie}")
+         raise # Let the db_transaction owner roll back the whole batch
     except sqlite3.Error as e:
         logger.error(f"Error inserting record into processed_posts for post {data.get('post_id')}: {e}")
-        conn.rollback()
+        raise # Let the db_transaction owner roll back the whole batch
+    return False
+
+def insert_processed_posts_many(conn: sqlite3.Connection, posts: list):
+    """Inserts several processed post records with one executemany. Does not commit; see db_transaction."""
+    if not posts:
+        return
+    rows = [
+        (
+            data.get('post_id'), data.get('post_url'), data.get('post_title'),
+            data.get('post_body'), data.get('created_utc')
+        )
+        for data in posts
+    ]
+    try:
+        conn.executemany(_SQL_INSERT_PROCESSED_POST, rows)
+        logger.info(f"Inserted {len(rows)} records into processed_posts (existing post_ids ignored).")
+    except sqlite3.Error as e:
+        logger.error(f"Error bulk inserting {len(rows)} records into processed_posts: {e}")
+        raise # Let the db_transaction owner roll back the whole batch
 
 # --- insert_llm_data (No changes needed here for this request) ---
 def insert_llm_data(conn: sqlite3.Connection, post_id: str, input_prompt: str, llm_response: str):
-    """Inserts LLM interaction data into the llm_data table."""
+    """Inserts LLM interaction data into the llm_data table. Does not commit; see db_transaction."""
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO llm_data (
-                post_id, input_prompt, llm_response
-            ) VALUES (?, ?, ?)
-            ON CONFLICT(post_id) DO UPDATE SET
-                input_prompt = excluded.input_prompt,
-                llm_response = excluded.llm_response,
-                created_at = CURRENT_TIMESTAMP;
-        """, (post_id, input_prompt, llm_response))
-        conn.commit()
-        logger.info(f"Inserted/Updated record in llm_data for post_id: {post_id}")
+        conn.execute(_SQL_INSERT_LLM_DATA, (post_id, input_prompt, llm_response))
+        logger.debug("Inserted/Updated record in llm_data for post_id: {}", post_id)
     except sqlite3.IntegrityError as ie:
         logger.error(f"Integrity Error inserting LLM data for post {post_id}: {ie}. Does the processed_posts record exist?")
-        conn.rollback()
+        raise # Let the db_transaction owner roll back the whole batch
     except sqlite3.Error as e:
         logger.error(f"Error inserting LLM data for post {post_id}: {e}")
-        conn.rollback()
+        raise # Let the db_transaction owner roll back the whole batch
 
 # --- insert_post_comment (New function) ---
 def insert_post_comment(conn: sqlite3.Connection, comment_data: dict):
-    """Inserts data for a single comment into the post_comments table."""
+    """
+    Inserts data for a single comment into the post_comments table.
+
+    Deprecated: prefer insert_post_comments_many, which sends a whole batch in one executemany.
+    """
+    insert_post_comments_many(conn, [comment_data])
+
+def insert_post_comments_many(conn: sqlite3.Connection, comment_list: list):
+    """Inserts data for several comments into the post_comments table. Does not commit; see db_transaction."""
+    if not comment_list:
+        return
+    rows = [
+        (
+            c.get('post_id'),
+            c.get('comment_id'),
+            c.get('comment_body'),
+            c.get('comment_score'),
+            c.get('comment_rank'),
+            c.get('is_actual_advice'), # Should be bool or None
+            c.get('similarity_score') # Should be float or None
+        )
+        for c in comment_list
+    ]
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO post_comments (
-                post_id, comment_id, comment_body, comment_score, comment_rank,
-                is_actual_advice, similarity_score
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(comment_id) DO UPDATE SET
-                comment_score = excluded.comment_score,
-                is_actual_advice = excluded.is_actual_advice,
-                similarity_score = excluded.similarity_score,
-                fetched_at = CURRENT_TIMESTAMP;
-                -- Note: We generally don't update rank or body on conflict
-        """, (
-            comment_data.get('post_id'),
-            comment_data.get('comment_id'),
-            comment_data.get('comment_body'),
-            comment_data.get('comment_score'),
-            comment_data.get('comment_rank'),
-            comment_data.get('is_actual_advice'), # Should be bool or None
-            comment_data.get('similarity_score') # Should be float or None
-        ))
-        conn.commit()
-        logger.debug(f"Inserted/Updated comment {comment_data.get('comment_id')} for post {comment_data.get('post_id')}")
+        conn.executemany(_SQL_INSERT_COMMENT, rows)
+        logger.debug("Inserted/Updated {} records in post_comments", len(rows))
     except sqlite3.IntegrityError as ie:
-         logger.error(f"Integrity Error inserting comment {comment_data.get('comment_id')}: {ie}. Does post {comment_data.get('post_id')} exist?")
-         conn.rollback()
+         logger.error(f"Integrity Error inserting {len(rows)} comments: {ie}. Do the referenced posts exist?")
+         raise # Let the db_transaction owner roll back the whole batch
     except sqlite3.Error as e:
-        logger.error(f"Error inserting comment {comment_data.get('comment_id')}: {e}")
-        conn.rollback()
\ No newline at end of file
+        logger.error(f"Error inserting {len(rows)} comments: {e}")
+        raise # Let the db_transaction owner roll back the whole batch
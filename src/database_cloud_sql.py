@@ -1,24 +1,133 @@
 import os
-import datetime
-from contextlib import contextmanager # For session management alternative
+import io
+import csv
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager # For session management alternative
 from loguru import logger
-from typing import Generator, Optional
+from typing import AsyncGenerator, Generator, Optional, Tuple
 
 # Third-party imports
 import sqlalchemy
 from sqlalchemy import create_engine, text, exc
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import QueuePool
 
 # Google Cloud specific imports
-from google.cloud.sql.connector import Connector, IPTypes
+from google.cloud.sql.connector import Connector, IPTypes, create_async_connector
 
 # Local imports
 from . import config # Import necessary config variables
 
 # --- Global Variables ---
 connector: Optional[Connector] = None
-engine: Optional[sqlalchemy.engine.Engine] = None
-SessionLocal: Optional[sessionmaker[Session]] = None
+# The engine and the session factory are created once per process by the cached
+# get_engine() / get_session_local() below (reset by close_connection_pool()).
+
+# --- SQL Statements ---
+# Built once at import: reusing the same text() objects lets SQLAlchemy hit its
+# compiled-statement cache instead of re-analysing the SQL string on every call.
+# Using TIMESTAMPTZ for PostgreSQL timezone support.
+# Using BOOLEAN native type.
+# Using REAL which maps to float4 in PostgreSQL.
+_SQL_SCHEMA_STATEMENTS = (
+    text("""
+        CREATE TABLE IF NOT EXISTS processed_posts (
+            id SERIAL PRIMARY KEY,
+            post_id TEXT UNIQUE NOT NULL,
+            post_url TEXT NOT NULL,
+            post_title TEXT,
+            post_body TEXT,
+            created_utc TIMESTAMPTZ,
+            processed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+    text("CREATE INDEX IF NOT EXISTS idx_post_id ON processed_posts (post_id);"),
+    text("""
+        CREATE TABLE IF NOT EXISTS llm_data (
+            id SERIAL PRIMARY KEY,
+            post_id TEXT NOT NULL UNIQUE,
+            input_prompt TEXT NOT NULL,
+            llm_response TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
+        );
+    """),
+    # No separate index needed for llm_data.post_id due to UNIQUE constraint
+    text("""
+        CREATE TABLE IF NOT EXISTS post_comments (
+            id SERIAL PRIMARY KEY,
+            post_id TEXT NOT NULL,
+            comment_id TEXT UNIQUE NOT NULL,
+            comment_body TEXT,
+            comment_score INTEGER,
+            comment_rank INTEGER NOT NULL,
+            is_actual_advice BOOLEAN,
+            similarity_score REAL,
+            fetched_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
+        );
+    """),
+    text("CREATE INDEX IF NOT EXISTS idx_comment_post_id ON post_comments (post_id);"),
+    text("CREATE INDEX IF NOT EXISTS idx_comment_rank ON post_comments (comment_rank);"),
+    text("CREATE INDEX IF NOT EXISTS idx_comment_is_advice ON post_comments (is_actual_advice);"),
+    # Covering index for "best advice comment per post" lookups
+    text("CREATE INDEX IF NOT EXISTS idx_comment_post_rank ON post_comments (post_id, comment_rank, is_actual_advice);"),
+)
+# The whole schema as one multi-statement string (psycopg2 only)
+_SCHEMA_DDL = "\n".join(stmt.text for stmt in _SQL_SCHEMA_STATEMENTS)
+
+_SQL_PING = text("SELECT 1")
+_SQL_CHECK_POST = text("SELECT 1 FROM processed_posts WHERE post_id = :post_id LIMIT 1")
+_SQL_FILTER_PROCESSED_POSTS = text("SELECT post_id FROM processed_posts WHERE post_id = ANY(:post_ids)")
+_SQL_INSERT_PROCESSED_POST = text("""
+    INSERT INTO processed_posts (
+        post_id, post_url, post_title, post_body, created_utc
+    ) VALUES (:post_id, :post_url, :post_title, :post_body, to_timestamp(:created_utc))
+    ON CONFLICT (post_id) DO NOTHING;
+""")
+
+_SQL_INSERT_POST_AND_LLM = text("""
+    WITH ins AS (
+        INSERT INTO processed_posts (
+            post_id, post_url, post_title, post_body, created_utc
+        ) VALUES (:post_id, :post_url, :post_title, :post_body, to_timestamp(:created_utc))
+        ON CONFLICT (post_id) DO NOTHING
+        RETURNING post_id
+    )
+    INSERT INTO llm_data (post_id, input_prompt, llm_response)
+    VALUES (:post_id, :input_prompt, :llm_response)
+    ON CONFLICT (post_id) DO UPDATE SET
+        input_prompt = EXCLUDED.input_prompt,
+        llm_response = EXCLUDED.llm_response,
+        created_at = CURRENT_TIMESTAMP;
+""")
+
+# PostgreSQL ON CONFLICT syntax
+_SQL_UPSERT_LLM_DATA = text("""
+    INSERT INTO llm_data (post_id, input_prompt, llm_response)
+    VALUES (:post_id, :input_prompt, :llm_response)
+    ON CONFLICT (post_id) DO UPDATE SET
+        input_prompt = EXCLUDED.input_prompt,
+        llm_response = EXCLUDED.llm_response,
+        created_at = CURRENT_TIMESTAMP;
+""")
+
+_SQL_UPSERT_COMMENT = text("""
+    INSERT INTO post_comments (
+        post_id, comment_id, comment_body, comment_score, comment_rank,
+        is_actual_advice, similarity_score
+    ) VALUES (
+        :post_id, :comment_id, :comment_body, :comment_score, :comment_rank,
+        :is_actual_advice, :similarity_score
+    )
+    ON CONFLICT (comment_id) DO UPDATE SET
+        comment_score = EXCLUDED.comment_score,
+        is_actual_advice = EXCLUDED.is_actual_advice,
+        similarity_score = EXCLUDED.similarity_score,
+        fetched_at = CURRENT_TIMESTAMP;
+""")
 
 def init_connection_pool() -> sqlalchemy.engine.Engine:
     """
@@ -28,167 +137,271 @@ def init_connection_pool() -> sqlalchemy.engine.Engine:
     global connector
     if connector is None:
         logger.info("Initializing Cloud SQL Connector...")
-        connector = Connector()
+        # Lazy refresh fetches instance certificates on demand instead of running a
+        # background refresh thread, which suits short-lived Cloud Run jobs.
+        connector = Connector(refresh_strategy="lazy")
+
+    # Invariant for the process: resolved once here rather than on every pool refill
+    driver = config.DB_DRIVER.split('+')[1]     # "psycopg2" or "pg8000"
+    ip_type = IPTypes.PRIVATE if os.getenv("GOOGLE_CLOUD_RUN_JOB") else IPTypes.PUBLIC # Use Private IP within GCP VPC, Public for local dev/testing
 
     # Function to return database connection using connector
     def getconn() -> sqlalchemy.engine.interfaces.DBAPIConnection:
         conn = connector.connect(
             config.INSTANCE_CONNECTION_NAME,    # Cloud SQL Instance Connection Name
-            config.DB_DRIVER.split('+')[1],     # "psycopg2" or "pg8000"
+            driver,
             user=config.DB_USER,
             password=config.DB_PASS,
             db=config.DB_NAME,
-            ip_type=IPTypes.PRIVATE if os.getenv("GOOGLE_CLOUD_RUN_JOB") else IPTypes.PUBLIC, # Use Private IP within GCP VPC, Public for local dev/testing
+            ip_type=ip_type,
             enable_iam_auth=config.ENABLE_IAM_AUTH # Use IAM DB Auth if enabled and running in Cloud Run
         )
         logger.debug("Cloud SQL connection established via Connector.")
         return conn
 
+    # psycopg2: route executemany() of text() statements (e.g. insert_post_comments_bulk)
+    # through psycopg2's execute_batch helper instead of one statement per row.
+    # (SQLAlchemy 2.0 batches insert() constructs itself via "insertmanyvalues",
+    # sized by the engine-level insertmanyvalues_page_size.)
+    # pg8000 has no equivalent option and keeps the DBAPI's default executemany.
+    dialect_kwargs = {}
+    if config.DB_DRIVER.endswith("psycopg2"):
+        dialect_kwargs = {
+            "executemany_mode": "values_plus_batch",
+            "executemany_batch_page_size": 500,
+        }
+
     try:
         logger.info(f"Creating SQLAlchemy engine for {config.DB_DRIVER}...")
-        # Create the engine using the connector's connection function
-        # pool_size, max_overflow, etc. can be configured here if needed
+        # Create the engine using the connector's connection function.
+        # The engine (and its QueuePool) is created once per process via get_engine(),
+        # so every helper reuses pooled connections instead of dialing Cloud SQL again.
         # pool_timeout and pool_recycle are important for long-running apps, maybe less so for batch jobs
         db_engine = create_engine(
             f"{config.DB_DRIVER}://", # Use driver name from config
             creator=getconn,
-            pool_size=5,        # Default pool size
-            max_overflow=2,     # Default max overflow
+            poolclass=QueuePool,
+            pool_size=config.DB_POOL_SIZE,         # Connections kept open (DB_POOL_SIZE)
+            max_overflow=config.DB_MAX_OVERFLOW,   # Extra connections allowed under bursts (DB_MAX_OVERFLOW)
             pool_timeout=30,    # Wait 30s for a connection
-            pool_recycle=1800   # Recycle connections older than 30 mins
+            pool_recycle=1800,  # Recycle connections older than 30 mins
+            pool_pre_ping=True, # Transparently replace connections dropped by Cloud SQL
+            insertmanyvalues_page_size=1000, # Rows per multi-VALUES INSERT batch
+            **dialect_kwargs
         )
         logger.info("SQLAlchemy engine created successfully.")
         return db_engine
     except Exception as e:
-        logger.error(f"Error creating SQLAlchemy engine: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Error creating SQLAlchemy engine: {e}")
         raise
 
+@functools.cache
 def get_engine() -> sqlalchemy.engine.Engine:
-    """Returns the SQLAlchemy engine, initializing it if necessary."""
-    global engine
-    if engine is None:
-        engine = init_connection_pool()
-    return engine
+    """Returns the SQLAlchemy engine, initializing it on first use."""
+    return init_connection_pool()
+
+def _open_checked_connection(db_engine: sqlalchemy.engine.Engine) -> sqlalchemy.engine.Connection:
+    conn = db_engine.connect()
+    try:
+        conn.execute(_SQL_PING)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+def warm_up_pool():
+    """
+    Opens and checks pool_size connections up front, dialing them concurrently, then
+    returns them to the pool, so the first posts of a Cloud Run job don't pay the
+    connector's dial latency (and start-up pays roughly one dial, not pool_size).
+    """
+    db_engine = get_engine()
+    size = db_engine.pool.size()
+    connections = []
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, size), thread_name_prefix="db-warm-up") as executor:
+        futures = [executor.submit(_open_checked_connection, db_engine) for _ in range(size)]
+        for future in futures:
+            try:
+                connections.append(future.result())
+            except exc.SQLAlchemyError as e:
+                failures += 1
+                logger.warning(f"Connection pool warm-up failed to open a connection: {e}")
+    for conn in connections:
+        conn.close() # Returns the connection to the pool
+    if failures:
+        logger.warning(f"Warmed up {len(connections)} of {size} pooled database connections.")
+    else:
+        logger.info(f"Warmed up {len(connections)} pooled database connections.")
 
+@functools.cache
 def get_session_local() -> sessionmaker[Session]:
-    """Returns the SQLAlchemy SessionLocal factory, initializing it if necessary."""
-    global SessionLocal
-    if SessionLocal is None:
-        db_engine = get_engine()
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
-        logger.info("SQLAlchemy SessionLocal factory created.")
+    """Returns the SQLAlchemy SessionLocal factory, initializing it on first use."""
+    db_engine = get_engine()
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+    logger.info("SQLAlchemy SessionLocal factory created.")
     return SessionLocal
 
 # --- Context Manager for Sessions ---
 @contextmanager
 def get_db_session() -> Generator[Session, None, None]:
-    """Provide a transactional scope around a series of operations."""
-    session_factory = get_session_local()
-    session = session_factory()
+    """
+    Provide a transactional scope around a series of operations.
+
+    Each call opens its own session, so nested calls (or calls from several threads)
+    never commit, roll back or close a session owned by another scope.
+    """
+    SessionLocal = get_session_local()
+    session = SessionLocal()
     try:
         yield session
         session.commit()
         logger.debug("Session committed.")
     except Exception as e:
-        logger.error(f"Session rollback initiated due to error: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Session rollback initiated due to error: {e}")
         session.rollback()
         raise # Re-raise the exception after rollback
     finally:
-        session.close()
+        session.close() # Returns the connection to the pool
         logger.debug("Session closed.")
 
+# --- Async Engine (asyncpg) ---
+# An async engine and its connector are bound to the event loop that creates them,
+# so they live for one `async with async_engine_scope()` block (e.g. one asyncio.run()).
+
+async def init_async_connection_pool() -> Tuple[Connector, AsyncEngine]:
+    """
+    Initializes an asyncpg connection pool for Cloud SQL on the running event loop,
+    so DB writes can overlap with other awaited I/O (e.g. OpenAI requests).
+    """
+    logger.info("Initializing async Cloud SQL Connector...")
+    async_connector = await create_async_connector(refresh_strategy="lazy")
+    connect_kwargs = {
+        "user": config.DB_USER,
+        "password": config.DB_PASS,
+        "db": config.DB_NAME,
+        "ip_type": IPTypes.PRIVATE if os.getenv("GOOGLE_CLOUD_RUN_JOB") else IPTypes.PUBLIC,
+        "enable_iam_auth": config.ENABLE_IAM_AUTH,
+    }
+
+    async def async_getconn():
+        conn = await async_connector.connect_async(
+            config.INSTANCE_CONNECTION_NAME, "asyncpg", **connect_kwargs
+        )
+        logger.debug("Async Cloud SQL connection established via Connector.")
+        return conn
+
+    async_engine = create_async_engine(
+        "postgresql+asyncpg://",
+        async_creator=async_getconn,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=30,
+        pool_recycle=1800,
+        pool_pre_ping=True,
+    )
+    logger.info("SQLAlchemy async engine created successfully.")
+    return async_connector, async_engine
+
+@asynccontextmanager
+async def async_engine_scope() -> AsyncGenerator[AsyncEngine, None]:
+    """Yields an async engine for the running event loop, disposing it and its connector afterwards."""
+    async_connector, async_engine = await init_async_connection_pool()
+    try:
+        yield async_engine
+    finally:
+        await async_engine.dispose()
+        await async_connector.close_async()
+        logger.info("SQLAlchemy async engine disposed and Cloud SQL Connector closed.")
+
+@asynccontextmanager
+async def get_async_db_session(async_engine: AsyncEngine) -> AsyncGenerator[AsyncSession, None]:
+    """Async counterpart of get_db_session(): commits on success, rolls back on error."""
+    session_factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    async with session_factory() as session:
+        try:
+            yield session
+            await session.commit()
+            logger.debug("Async session committed.")
+        except Exception as e:
+            logger.opt(exception=True).error(f"Async session rollback initiated due to error: {e}")
+            await session.rollback()
+            raise
+
 # --- Database Operations ---
 
+@contextmanager
+def _session_scope(session: Optional[Session] = None) -> Generator[Session, None, None]:
+    """
+    Yields the caller's session, leaving commit/rollback to its owner, or opens a
+    new transactional session when none is given.
+    """
+    if session is not None:
+        yield session
+    else:
+        with get_db_session() as new_session:
+            yield new_session
+
 def create_tables():
     """Creates the necessary tables using raw SQL if they don't exist."""
     # Note: Using SQLAlchemy models and metadata.create_all(engine) is more robust
     # But sticking to raw SQL for minimal changes from original code.
-    # Using TIMESTAMPTZ for PostgreSQL timezone support.
-    # Using BOOLEAN native type.
-    # Using REAL which maps to float4 in PostgreSQL.
-    create_posts_sql = text("""
-        CREATE TABLE IF NOT EXISTS processed_posts (
-            id SERIAL PRIMARY KEY,
-            post_id TEXT UNIQUE NOT NULL,
-            post_url TEXT NOT NULL,
-            post_title TEXT,
-            post_body TEXT,
-            created_utc TIMESTAMPTZ,
-            processed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    create_posts_idx_sql = text("CREATE INDEX IF NOT EXISTS idx_post_id ON processed_posts (post_id);")
-
-    create_llm_sql = text("""
-        CREATE TABLE IF NOT EXISTS llm_data (
-            id SERIAL PRIMARY KEY,
-            post_id TEXT NOT NULL UNIQUE,
-            input_prompt TEXT NOT NULL,
-            llm_response TEXT NOT NULL,
-            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
-        );
-    """)
-    # No separate index needed for llm_data.post_id due to UNIQUE constraint
-
-    create_comments_sql = text("""
-        CREATE TABLE IF NOT EXISTS post_comments (
-            id SERIAL PRIMARY KEY,
-            post_id TEXT NOT NULL,
-            comment_id TEXT UNIQUE NOT NULL,
-            comment_body TEXT,
-            comment_score INTEGER,
-            comment_rank INTEGER NOT NULL,
-            is_actual_advice BOOLEAN,
-            similarity_score REAL,
-            fetched_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (post_id) REFERENCES processed_posts(post_id) ON DELETE CASCADE
-        );
-    """)
-    create_comments_idx_post_sql = text("CREATE INDEX IF NOT EXISTS idx_comment_post_id ON post_comments (post_id);")
-    create_comments_idx_rank_sql = text("CREATE INDEX IF NOT EXISTS idx_comment_rank ON post_comments (comment_rank);")
-    create_comments_idx_advice_sql = text("CREATE INDEX IF NOT EXISTS idx_comment_is_advice ON post_comments (is_actual_advice);")
-
+    # The statements themselves are in _SQL_SCHEMA_STATEMENTS.
     logger.info("Attempting to create/verify database tables...")
     try:
         with get_db_session() as session:
-            session.execute(create_posts_sql)
-            session.execute(create_posts_idx_sql)
-            session.execute(create_llm_sql)
-            session.execute(create_comments_sql)
-            session.execute(create_comments_idx_post_sql)
-            session.execute(create_comments_idx_rank_sql)
-            session.execute(create_comments_idx_advice_sql)
+            if config.DB_DRIVER.endswith("psycopg2"):
+                # psycopg2 accepts semicolon-separated statements: one round-trip for the whole schema
+                session.connection().exec_driver_sql(_SCHEMA_DDL)
+            else:
+                # pg8000 prepares each statement, which rejects multi-statement strings
+                for stmt in _SQL_SCHEMA_STATEMENTS:
+                    session.execute(stmt)
         logger.info("Database tables checked/created successfully.")
     except exc.SQLAlchemyError as e:
-        logger.error(f"Error creating database tables: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Error creating database tables: {e}")
         raise
 
 
-def check_post_processed(post_id: str) -> bool:
+def check_post_processed(post_id: str, session: Optional[Session] = None) -> bool:
     """Checks if a post_id already exists in the processed_posts table."""
-    query = text("SELECT 1 FROM processed_posts WHERE post_id = :post_id LIMIT 1")
     try:
-        with get_db_session() as session:
-            result = session.execute(query, {"post_id": post_id}).scalar_one_or_none()
+        with _session_scope(session) as db_session:
+            result = db_session.execute(_SQL_CHECK_POST, {"post_id": post_id}).scalar_one_or_none()
             return result is not None
     except exc.SQLAlchemyError as e:
-        logger.error(f"Error checking if post {post_id} is processed: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Error checking if post {post_id} is processed: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
         return False # Assume not processed on error
 
-def insert_processed_post(data: dict):
-    """Inserts a processed post record (post-level data only)."""
+def filter_processed_post_ids(post_ids: list, session: Optional[Session] = None) -> set:
+    """
+    Returns the subset of post_ids already present in processed_posts, in one query.
+    """
+    if not post_ids:
+        return set()
+    try:
+        with _session_scope(session) as db_session:
+            return set(db_session.execute(_SQL_FILTER_PROCESSED_POSTS, {"post_ids": list(post_ids)}).scalars())
+    except exc.SQLAlchemyError as e:
+        logger.opt(exception=True).error(f"Error checking which of {len(post_ids)} posts are processed: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+        return set() # Assume none processed on error
+
+def insert_processed_post(data: dict, session: Optional[Session] = None) -> bool:
+    """
+    Inserts a processed post record (post-level data only).
+
+    Returns:
+        True if the post was newly inserted, False if it already existed or the insert failed.
+    """
     created_utc_val = data.get('created_utc')
-    # Basic type check, already handles datetime in scraper
-    if created_utc_val and not isinstance(created_utc_val, datetime.datetime):
-         logger.warning(f"Non-datetime value passed for created_utc: {created_utc_val}. Attempting insert anyway.")
+    # Basic type check: the scraper passes epoch seconds, converted by to_timestamp() in SQL
+    if created_utc_val is not None and not isinstance(created_utc_val, (int, float)):
+         logger.warning(f"Non-epoch value passed for created_utc: {created_utc_val}. Attempting insert anyway.")
 
-    sql = text("""
-        INSERT INTO processed_posts (
-            post_id, post_url, post_title, post_body, created_utc
-        ) VALUES (:post_id, :post_url, :post_title, :post_body, :created_utc)
-        ON CONFLICT (post_id) DO NOTHING;
-    """)
     params = {
         "post_id": data.get('post_id'),
         "post_url": data.get('post_url'),
@@ -197,60 +410,138 @@ def insert_processed_post(data: dict):
         "created_utc": created_utc_val
     }
     try:
-        with get_db_session() as session:
-            result = session.execute(sql, params)
-            if result.rowcount > 0:
-                logger.info(f"Inserted record into processed_posts for post_id: {data.get('post_id')}")
+        with _session_scope(session) as db_session:
+            result = db_session.execute(_SQL_INSERT_PROCESSED_POST, params)
+            inserted = result.rowcount > 0
+            if inserted:
+                logger.debug("Inserted record into processed_posts for post_id: {}", data.get('post_id'))
             # No warning needed for rowcount == 0 due to ON CONFLICT DO NOTHING
+        return inserted
     except exc.IntegrityError:
          # Should ideally not happen with ON CONFLICT DO NOTHING unless another constraint fails
          logger.warning(f"Integrity Error on insert into processed_posts for post {data.get('post_id')}. Might indicate unexpected issue.")
+         if session is not None:
+             raise # Let the caller's transaction roll back
     except exc.SQLAlchemyError as e:
-        logger.error(f"Error inserting record into processed_posts for post {data.get('post_id')}: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Error inserting record into processed_posts for post {data.get('post_id')}: {e}")
         # Rollback is handled by context manager
+        if session is not None:
+            raise # Let the caller's transaction roll back
+    return False
 
-def insert_llm_data(post_id: str, input_prompt: str, llm_response: str):
+def insert_llm_data(post_id: str, input_prompt: str, llm_response: str, session: Optional[Session] = None):
     """Inserts LLM interaction data into the llm_data table."""
-    # PostgreSQL ON CONFLICT syntax
-    sql = text("""
-        INSERT INTO llm_data (post_id, input_prompt, llm_response)
-        VALUES (:post_id, :input_prompt, :llm_response)
-        ON CONFLICT (post_id) DO UPDATE SET
-            input_prompt = EXCLUDED.input_prompt,
-            llm_response = EXCLUDED.llm_response,
-            created_at = CURRENT_TIMESTAMP;
-    """)
     params = {
         "post_id": post_id,
         "input_prompt": input_prompt,
         "llm_response": llm_response
     }
     try:
-        with get_db_session() as session:
-            session.execute(sql, params)
-            logger.debug(f"Inserted/Updated record in llm_data for post_id: {post_id}")
+        with _session_scope(session) as db_session:
+            db_session.execute(_SQL_UPSERT_LLM_DATA, params)
+            logger.debug("Inserted/Updated record in llm_data for post_id: {}", post_id)
     except exc.IntegrityError as ie:
-        logger.error(f"Integrity Error inserting LLM data for post {post_id}: {ie}. FK constraint failed?", exc_info=True)
+        logger.error(f"Integrity Error inserting LLM data for post {post_id}: {ie}. FK constraint failed?")
+        if session is not None:
+            raise # Let the caller's transaction roll back
     except exc.SQLAlchemyError as e:
-        logger.error(f"Error inserting LLM data for post {post_id}: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Error inserting LLM data for post {post_id}: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
 
-def insert_post_comment(comment_data: dict):
+def insert_post_and_llm(post_data: dict, input_prompt: str, llm_response: str, session: Optional[Session] = None):
+    """
+    Inserts the processed post (if new) and upserts its LLM data in a single statement.
+
+    The llm_data row does not depend on the CTE's output: data-modifying CTEs always run,
+    and the foreign key is checked at the end of the statement, after the post row exists.
+    """
+    post_id = post_data.get('post_id')
+    params = {
+        "post_id": post_id,
+        "post_url": post_data.get('post_url'),
+        "post_title": post_data.get('post_title'),
+        "post_body": post_data.get('post_body'),
+        "created_utc": post_data.get('created_utc'),
+        "input_prompt": input_prompt,
+        "llm_response": llm_response
+    }
+    try:
+        with _session_scope(session) as db_session:
+            db_session.execute(_SQL_INSERT_POST_AND_LLM, params)
+            logger.debug("Inserted post and inserted/updated llm_data for post_id: {}", post_id)
+    except exc.IntegrityError as ie:
+        logger.error(f"Integrity Error inserting post and LLM data for post {post_id}: {ie}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+    except exc.SQLAlchemyError as e:
+        logger.opt(exception=True).error(f"Error inserting post and LLM data for post {post_id}: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+
+def insert_posts_and_llm_bulk(posts: list, session: Optional[Session] = None):
+    """
+    Batch version of insert_post_and_llm: runs the same statement once as an executemany.
+
+    Args:
+        posts: Dicts with the post_data fields plus 'input_prompt' and 'llm_response'.
+    """
+    if not posts:
+        return
+    params = [
+        {
+            "post_id": post.get('post_id'),
+            "post_url": post.get('post_url'),
+            "post_title": post.get('post_title'),
+            "post_body": post.get('post_body'),
+            "created_utc": post.get('created_utc'),
+            "input_prompt": post.get('input_prompt'),
+            "llm_response": post.get('llm_response')
+        }
+        for post in posts
+    ]
+    try:
+        with _session_scope(session) as db_session:
+            db_session.execute(_SQL_INSERT_POST_AND_LLM, params)
+            logger.debug("Inserted {} posts and inserted/updated their llm_data", len(params))
+    except exc.IntegrityError as ie:
+        logger.error(f"Integrity Error inserting {len(params)} posts and their LLM data: {ie}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+    except exc.SQLAlchemyError as e:
+        logger.opt(exception=True).error(f"Error inserting {len(params)} posts and their LLM data: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+
+# Columns written for each post_comments row (also the COPY column order)
+_COMMENT_COLUMNS = (
+    "post_id", "comment_id", "comment_body", "comment_score", "comment_rank",
+    "is_actual_advice", "similarity_score",
+)
+# Above this many rows, insert_post_comments_bulk switches to the COPY staging path
+_COPY_THRESHOLD = 50
+
+# Staging-table ingest for bulk_copy_comments: COPY into a session-local temp table
+# (column types only, no constraints), then one set-based upsert into post_comments.
+_COMMENT_STAGE_DDL = f"""
+    CREATE TEMP TABLE IF NOT EXISTS _stage_comments ON COMMIT DELETE ROWS AS
+    SELECT {', '.join(_COMMENT_COLUMNS)} FROM post_comments WITH NO DATA;
+    TRUNCATE _stage_comments;
+"""
+_COMMENT_STAGE_COPY = f"COPY _stage_comments ({', '.join(_COMMENT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+# DISTINCT ON: ON CONFLICT DO UPDATE cannot touch the same comment_id twice in one statement
+_COMMENT_STAGE_MERGE = f"""
+    INSERT INTO post_comments ({', '.join(_COMMENT_COLUMNS)})
+    SELECT DISTINCT ON (comment_id) {', '.join(_COMMENT_COLUMNS)} FROM _stage_comments
+    ON CONFLICT (comment_id) DO UPDATE SET
+        comment_score = EXCLUDED.comment_score,
+        is_actual_advice = EXCLUDED.is_actual_advice,
+        similarity_score = EXCLUDED.similarity_score,
+        fetched_at = CURRENT_TIMESTAMP;
+"""
+
+def insert_post_comment(comment_data: dict, session: Optional[Session] = None):
     """Inserts data for a single comment into the post_comments table."""
-     # PostgreSQL ON CONFLICT syntax
-    sql = text("""
-        INSERT INTO post_comments (
-            post_id, comment_id, comment_body, comment_score, comment_rank,
-            is_actual_advice, similarity_score
-        ) VALUES (
-            :post_id, :comment_id, :comment_body, :comment_score, :comment_rank,
-            :is_actual_advice, :similarity_score
-        )
-        ON CONFLICT (comment_id) DO UPDATE SET
-            comment_score = EXCLUDED.comment_score,
-            is_actual_advice = EXCLUDED.is_actual_advice,
-            similarity_score = EXCLUDED.similarity_score,
-            fetched_at = CURRENT_TIMESTAMP;
-    """)
     params = {
         "post_id": comment_data.get('post_id'),
         "comment_id": comment_data.get('comment_id'),
@@ -261,29 +552,101 @@ def insert_post_comment(comment_data: dict):
         "similarity_score": comment_data.get('similarity_score')
     }
     try:
-        with get_db_session() as session:
-            session.execute(sql, params)
-            logger.debug(f"Inserted/Updated comment {comment_data.get('comment_id')} for post {comment_data.get('post_id')}")
+        with _session_scope(session) as db_session:
+            db_session.execute(_SQL_UPSERT_COMMENT, params)
+            logger.opt(lazy=True).debug(
+                "Inserted/Updated comment {} for post {}",
+                lambda: comment_data.get('comment_id'), lambda: comment_data.get('post_id'),
+            )
+    except exc.IntegrityError as ie:
+         logger.error(f"Integrity Error inserting comment {comment_data.get('comment_id')}: {ie}. FK constraint failed?")
+         if session is not None:
+             raise # Let the caller's transaction roll back
+    except exc.SQLAlchemyError as e:
+        logger.opt(exception=True).error(f"Error inserting comment {comment_data.get('comment_id')}: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+
+def insert_post_comments_bulk(comment_list: list, session: Optional[Session] = None):
+    """
+    Upserts all comments of a post in one session, sending the rows as a single executemany
+    (or, for more than _COPY_THRESHOLD rows on psycopg2, through bulk_copy_comments).
+    """
+    if not comment_list:
+        return
+    if len(comment_list) > _COPY_THRESHOLD and config.DB_DRIVER.endswith("psycopg2"):
+        bulk_copy_comments(comment_list, session=session)
+        return
+    params = [{col: comment_data.get(col) for col in _COMMENT_COLUMNS} for comment_data in comment_list]
+    try:
+        with _session_scope(session) as db_session:
+            db_session.execute(_SQL_UPSERT_COMMENT, params)
+            logger.debug("Inserted/Updated {} comments in post_comments", len(params))
     except exc.IntegrityError as ie:
-         logger.error(f"Integrity Error inserting comment {comment_data.get('comment_id')}: {ie}. FK constraint failed?", exc_info=True)
+         logger.error(f"Integrity Error inserting {len(params)} comments: {ie}. FK constraint failed?")
+         if session is not None:
+             raise # Let the caller's transaction roll back
     except exc.SQLAlchemyError as e:
-        logger.error(f"Error inserting comment {comment_data.get('comment_id')}: {e}", exc_info=True)
+        logger.opt(exception=True).error(f"Error inserting {len(params)} comments: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
+
+def _rows_to_csv(rows: list, columns: tuple) -> io.StringIO:
+    """Serializes dict rows to an in-memory CSV buffer (None -> unquoted empty field -> NULL)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["" if row.get(col) is None else row.get(col) for col in columns])
+    buffer.seek(0)
+    return buffer
+
+def bulk_copy_comments(comment_list: list, session: Optional[Session] = None):
+    """
+    Upserts many comments via COPY ... FROM STDIN into a temp staging table followed by
+    a single INSERT ... SELECT ... ON CONFLICT (psycopg2 only).
+
+    COPY bypasses the per-row parse/plan of INSERT; the staging table adds back the
+    upsert semantics COPY lacks, so existing comments are updated, not rejected.
+    """
+    if not comment_list:
+        return
+    if not config.DB_DRIVER.endswith("psycopg2"):
+        # pg8000 has no copy_expert; fall back to the executemany upsert
+        insert_post_comments_bulk(comment_list, session=session)
+        return
+
+    buffer = _rows_to_csv(comment_list, _COMMENT_COLUMNS)
+    try:
+        with _session_scope(session) as db_session:
+            # Drop down to the raw DBAPI (psycopg2) connection checked out by this session
+            raw_cursor = db_session.connection().connection.cursor()
+            try:
+                raw_cursor.execute(_COMMENT_STAGE_DDL)
+                raw_cursor.copy_expert(_COMMENT_STAGE_COPY, buffer)
+                raw_cursor.execute(_COMMENT_STAGE_MERGE)
+            finally:
+                raw_cursor.close()
+        logger.info(f"Upserted {len(comment_list)} comments into post_comments via COPY staging.")
+    except Exception as e:
+        logger.opt(exception=True).error(f"Error copying {len(comment_list)} comments into post_comments: {e}")
+        if session is not None:
+            raise # Let the caller's transaction roll back
 
 
 # --- Cleanup Function (Optional) ---
 def close_connection_pool():
     """Closes the Cloud SQL connector and disposes the engine."""
-    global engine, connector, SessionLocal
+    global connector
     logger.info("Attempting to close database connection pool...")
-    if engine:
-        engine.dispose()
-        engine = None
+    get_session_local.cache_clear()
+    if get_engine.cache_info().currsize:
+        get_engine().dispose()
+        get_engine.cache_clear()
         logger.info("SQLAlchemy engine disposed.")
     if connector:
         connector.close()
         connector = None
         logger.info("Cloud SQL Connector closed.")
-    SessionLocal = None
 
 # It's generally recommended to initialize the engine once when the application starts.
 # For a script like this, calling get_engine() the first time a connection is needed works.
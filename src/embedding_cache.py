@@ -0,0 +1,101 @@
+import functools
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Callable, List
+import numpy as np
+from loguru import logger
+from . import config, database
+
+# Embeddings live in the SQLite file at EMBEDDING_CACHE_PATH (by default the local
+# database, next to the other tables). It only helps where that file persists between
+# runs, e.g. local runs or a volume mounted into the Cloud Run job.
+# Vectors are stored as float16 bytes (half the size; plenty for cosine similarity).
+_SQL_CREATE_EMBEDDINGS = """
+    CREATE TABLE IF NOT EXISTS embeddings (
+        hash TEXT NOT NULL,
+        model TEXT NOT NULL,
+        dim INTEGER NOT NULL,
+        vec BLOB NOT NULL,
+        PRIMARY KEY (hash, model)
+    ) WITHOUT ROWID;
+"""
+_SQL_INSERT_EMBEDDING = "INSERT OR REPLACE INTO embeddings (hash, model, dim, vec) VALUES (?, ?, ?, ?)"
+# Stay well below SQLite's bound-parameter limit in IN (...) lookups
+_MAX_IN_PARAMS = 500
+
+def _text_hash(text: str) -> str:
+    """SHA-256 hex digest identifying a text."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+@functools.cache
+def _get_connection() -> sqlite3.Connection:
+    """Opens the cache's SQLite connection on first use, creating the embeddings table."""
+    path = Path(config.EMBEDDING_CACHE_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL;") # Shares the file with the pipeline's own connection by default
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(_SQL_CREATE_EMBEDDINGS)
+    conn.commit()
+    logger.info(f"Embedding cache opened: {path}")
+    return conn
+
+
+def _load_cached(conn: sqlite3.Connection, hashes: List[str], model_key: str) -> dict:
+    """Returns {hash: float32 vector} for the hashes already cached under model_key."""
+    cached = {}
+    for start in range(0, len(hashes), _MAX_IN_PARAMS):
+        chunk = hashes[start:start + _MAX_IN_PARAMS]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT hash, vec FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+            [model_key, *chunk],
+        )
+        for text_hash, vec in rows:
+            cached[text_hash] = np.frombuffer(vec, dtype=np.float16).astype(np.float32)
+    return cached
+
+
+def get_or_compute(texts: List[str], encode: Callable[[List[str]], np.ndarray], model_key: str) -> np.ndarray:
+    """
+    Returns one embedding per text (rows in input order), encoding only the texts
+    not yet cached under model_key and caching the new ones.
+
+    Args:
+        texts: Texts to embed.
+        encode: Function embedding a list of texts (e.g. text_analyzer.encode).
+        model_key: Identifies the model and its precision (e.g. "all-MiniLM-L6-v2@int8"),
+            so vectors from different models or precision modes are never mixed.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    if not config.EMBEDDING_CACHE_PATH:
+        return encode(texts)
+
+    hashes = [_text_hash(text) for text in texts]
+    try:
+        conn = _get_connection()
+        cached = _load_cached(conn, hashes, model_key)
+    except (sqlite3.Error, OSError) as e: # OSError: the database directory cannot be created
+        logger.warning(f"Embedding cache unavailable, encoding all {len(texts)} texts: {e}")
+        return encode(texts)
+
+    # Distinct misses only: the same text appearing twice is encoded once
+    misses = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in cached}
+    if misses:
+        fresh = encode(list(misses.values()))
+        for text_hash, vector in zip(misses, fresh):
+            cached[text_hash] = vector
+        try:
+            with database.db_transaction(conn):
+                conn.executemany(_SQL_INSERT_EMBEDDING, [
+                    (text_hash, model_key, vector.shape[0], vector.astype(np.float16).tobytes())
+                    for text_hash, vector in zip(misses, fresh)
+                ])
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Could not store {len(misses)} embeddings in the cache: {e}")
+
+    logger.debug("Embedding cache: {} hits, {} computed.", len(texts) - len(misses), len(misses))
+    return np.stack([cached[text_hash] for text_hash in hashes])
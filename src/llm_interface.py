@@ -1,22 +1,119 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
 import openai
 from . import config
 from loguru import logger
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 LLM_NAME = 'gpt-4o-mini'
+# Upper bound on in-flight async requests (keep within the account's RPM/TPM limits)
+MAX_CONCURRENT_REQUESTS = 4
+# Client-side request budget; 429s beyond it are retried by the OpenAI client itself
+LLM_REQUESTS_PER_SECOND = 5
+LLM_BURST = 10
+LLM_MAX_RETRIES = 5
+# Verification answers remembered per process (keyed by a hash of post + comment text)
+VERIFICATION_CACHE_SIZE = 10_000
+
+
+class RateLimiter:
+    """Token bucket: allows `burst` requests at once, refilled at `rps` tokens per second."""
+
+    def __init__(self, rps: float, burst: int = 1):
+        self.rps = rps
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Takes a token and returns how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rps)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rps
+
+    def acquire(self):
+        """Blocks only while the bucket is empty."""
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        """Async variant of acquire()."""
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+rate_limiter = RateLimiter(rps=LLM_REQUESTS_PER_SECOND, burst=LLM_BURST)
+
+# Prompt templates (filled with str.format; literal braces are doubled)
+_ADVICE_PROMPT_TMPL = """
+    O seguinte post foi feito no subreddit r/desabafos. Por favor, leia o título e o corpo do post e forneça um conselho ou uma perspectiva útil, empática e construtiva para o autor original (OP). Concentre-se em ser solidário e evite julgamentos.
+
+    Título: {title}
+
+    Corpo:
+    {body}
+
+    Seu conselho/perspectiva para o OP:
+    """
+
+_VERIFY_PROMPT_TMPL = """
+    Contexto: Post Original no r/desabafos
+    Título: {title}
+    Corpo: {body}
+    ---
+    Comentário feito neste post:
+    "{comment}"
+    ---
+    Pergunta: Este comentário está fornecendo conselho direto, apoio emocional, uma perspectiva relevante ou uma pergunta construtiva em resposta direta ao conteúdo e desabafo do post original? Foque em diferenciar conselhos/apoio de mensagens automáticas de MOD, perguntas genéricas não relacionadas ao desabafo (ex: "O que aconteceu?"), ou meta-comentários sobre o Reddit.
+
+    Responda APENAS com "Sim" ou "Não".
+    """
+
+_VERIFY_BATCH_PROMPT_TMPL = """
+    Contexto: Post Original no r/desabafos
+    Título: {title}
+    Corpo: {body}
+    ---
+    Comentários feitos neste post ({n_comments}):
+    {comments}
+    ---
+    Pergunta: Para cada um dos {n_comments} comentários acima, o comentário está fornecendo conselho direto, apoio emocional, uma perspectiva relevante ou uma pergunta construtiva em resposta direta ao conteúdo e desabafo do post original? Foque em diferenciar conselhos/apoio de mensagens automáticas de MOD, perguntas genéricas não relacionadas ao desabafo (ex: "O que aconteceu?"), ou meta-comentários sobre o Reddit.
+
+    Responda APENAS com um objeto JSON no formato {{"respostas": ["Sim", "Não", ...]}}, com exatamente {n_comments} respostas, na ordem dos comentários.
+    """
 
 # Initialize OpenAI client
 try:
     # Consider adding timeout configuration
     client = openai.OpenAI(
         api_key=config.OPENAI_API_KEY,
-        timeout=30.0 # Example timeout
+        timeout=30.0, # Example timeout
+        max_retries=LLM_MAX_RETRIES # Exponential backoff on 429/5xx
     )
     logger.info("OpenAI client initialized.")
 except Exception as e:
     logger.error(f"Failed to initialize OpenAI client: {e}")
     client = None
 
+def _build_advice_messages(post_title: str, post_body: str) -> Tuple[str, List[Dict[str, str]]]:
+    """Builds the OP advice prompt and the chat messages that carry it."""
+    prompt = _ADVICE_PROMPT_TMPL.format(title=post_title, body=post_body)
+    messages = [
+        {"role": "system", "content": "Você é um assistente prestativo e empático que oferece conselhos construtivos e solidários para posts do r/desabafos."},
+        {"role": "user", "content": prompt}
+    ]
+    return prompt, messages
+
 def get_llm_response(post_title: str, post_body: str) -> Optional[Dict[str, str]]:
     """
     Gets advice/perspective from the LLM based on the original post content.
@@ -28,30 +125,19 @@ def get_llm_response(post_title: str, post_body: str) -> Optional[Dict[str, str]
         logger.error("LLM client (get_llm_response) is not initialized.")
         return None
 
-    prompt = f"""
-    O seguinte post foi feito no subreddit r/desabafos. Por favor, leia o título e o corpo do post e forneça um conselho ou uma perspectiva útil, empática e construtiva para o autor original (OP). Concentre-se em ser solidário e evite julgamentos.
-
-    Título: {post_title}
-
-    Corpo:
-    {post_body}
-
-    Seu conselho/perspectiva para o OP:
-    """
+    prompt, messages = _build_advice_messages(post_title, post_body)
 
     try:
-        logger.debug(f"Sending OP advice prompt to LLM for post title: {post_title[:50]}...")
+        logger.debug("Sending OP advice prompt to LLM for post title: {}...", post_title[:50])
+        rate_limiter.acquire()
         response = client.chat.completions.create(
             model=LLM_NAME, # Consider cost/speed vs quality (maybe GPT-4 for main advice?)
-            messages=[
-                {"role": "system", "content": "Você é um assistente prestativo e empático que oferece conselhos construtivos e solidários para posts do r/desabafos."},
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             max_tokens=350, # Slightly increased tokens maybe
             temperature=0.7,
         )
         llm_answer = response.choices[0].message.content.strip()
-        logger.info(f"Received LLM OP advice response for post title: {post_title[:50]}...")
+        logger.info("Received LLM OP advice response for post title: {}...", post_title[:50])
         return {"prompt": prompt, "response": llm_answer}
 
     except openai.APITimeoutError:
@@ -59,11 +145,112 @@ def get_llm_response(post_title: str, post_body: str) -> Optional[Dict[str, str]
     except openai.APIError as e:
         logger.error(f"OpenAI API error (get_llm_response): {e}")
     except Exception as e:
-        logger.error(f"Error getting LLM response (get_llm_response): {e}", exc_info=True)
+        logger.opt(exception=True).error("Error getting LLM response (get_llm_response): {}", e)
 
     return None
 
+async def get_llm_response_async(
+    async_client: openai.AsyncOpenAI,
+    post_title: str,
+    post_body: str,
+    semaphore: Optional[asyncio.Semaphore] = None,
+) -> Optional[Dict[str, str]]:
+    """
+    Async variant of get_llm_response; the semaphore bounds how many requests are in flight.
+
+    Returns:
+        A dictionary containing 'prompt' and 'response' on success, None on failure.
+    """
+    prompt, messages = _build_advice_messages(post_title, post_body)
+    semaphore = semaphore or asyncio.Semaphore(1)
+
+    try:
+        async with semaphore:
+            await rate_limiter.acquire_async()
+            logger.debug("Sending OP advice prompt to LLM (async) for post title: {}...", post_title[:50])
+            response = await async_client.chat.completions.create(
+                model=LLM_NAME,
+                messages=messages,
+                max_tokens=350,
+                temperature=0.7,
+            )
+        llm_answer = response.choices[0].message.content.strip()
+        logger.info("Received LLM OP advice response for post title: {}...", post_title[:50])
+        return {"prompt": prompt, "response": llm_answer}
+
+    except openai.APITimeoutError:
+        logger.error(f"OpenAI API request timed out (get_llm_response_async).")
+    except openai.APIError as e:
+        logger.error(f"OpenAI API error (get_llm_response_async): {e}")
+    except Exception as e:
+        logger.opt(exception=True).error("Error getting LLM response (get_llm_response_async): {}", e)
+
+    return None
+
+async def get_llm_responses_async(
+    posts: List[Tuple[str, str]],
+    max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+) -> List[Optional[Dict[str, str]]]:
+    """
+    Gets OP advice for several (post_title, post_body) pairs concurrently.
+
+    Returns:
+        One result per input post, in order (None where the request failed).
+    """
+    if not config.OPENAI_API_KEY:
+        logger.error("LLM client (get_llm_responses_async) has no API key configured.")
+        return [None] * len(posts)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # A fresh async client per call: its HTTP pool is bound to the running event loop
+    async with openai.AsyncOpenAI(
+        api_key=config.OPENAI_API_KEY, timeout=30.0, max_retries=LLM_MAX_RETRIES
+    ) as async_client:
+        return await asyncio.gather(*(
+            get_llm_response_async(async_client, post_title, post_body, semaphore)
+            for post_title, post_body in posts
+        ))
+
 # --- New function for comment verification ---
+_verification_cache: "OrderedDict[bytes, bool]" = OrderedDict()
+_verification_cache_lock = threading.Lock()
+
+def _verification_key(post_title: str, post_body: str, comment_body: str) -> bytes:
+    """16-byte blake2b digest of the texts a verification answer depends on."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (post_title, post_body, comment_body):
+        digest.update((part or "").encode())
+        digest.update(b"\0") # Separator, so ("ab", "c") and ("a", "bc") differ
+    return digest.digest()
+
+def _get_cached_verification(key: bytes) -> Optional[bool]:
+    """Returns a cached verification answer (marking it recently used), or None."""
+    with _verification_cache_lock:
+        answer = _verification_cache.get(key)
+        if answer is not None:
+            _verification_cache.move_to_end(key)
+        return answer
+
+def _cache_verification(key: bytes, answer: Optional[bool]):
+    """Remembers a definite answer; failed/ambiguous (None) answers are retried next time."""
+    if answer is None:
+        return
+    with _verification_cache_lock:
+        _verification_cache[key] = answer
+        _verification_cache.move_to_end(key)
+        if len(_verification_cache) > VERIFICATION_CACHE_SIZE:
+            _verification_cache.popitem(last=False)
+
+def _parse_verification_answer(answer: str) -> Optional[bool]:
+    """Maps a 'Sim'/'Não' classifier answer to True/False (None if ambiguous)."""
+    answer = answer.strip().lower()
+    if answer.startswith("sim"):
+        return True
+    elif answer.startswith("não") or answer.startswith("nao"):
+        return False
+    logger.warning(f"Ambiguous verification response: '{answer}'. Could not determine Yes/No.")
+    return None
+
 def verify_comment_advice(post_title: str, post_body: str, comment_body: str) -> Optional[bool]:
     """
     Uses LLM to verify if a comment is actual advice/support for the OP.
@@ -82,6 +269,12 @@ def verify_comment_advice(post_title: str, post_body: str, comment_body: str) ->
         logger.error("LLM client (verify_comment_advice) is not initialized.")
         return None
 
+    cache_key = _verification_key(post_title, post_body, comment_body)
+    cached_answer = _get_cached_verification(cache_key)
+    if cached_answer is not None:
+        logger.debug("Using cached verification for comment: {}...", comment_body[:60])
+        return cached_answer
+
     # Limit comment body length to avoid excessive token usage/cost
     max_comment_len = 500
     truncated_comment_body = comment_body[:max_comment_len]
@@ -93,21 +286,11 @@ def verify_comment_advice(post_title: str, post_body: str, comment_body: str) ->
     max_post_body_len = 1000
     truncated_post_body = post_body[:max_post_body_len] if post_body else ""
 
-    verification_prompt = f"""
-    Contexto: Post Original no r/desabafos
-    Título: {post_title}
-    Corpo: {truncated_post_body}
-    ---
-    Comentário feito neste post:
-    "{truncated_comment_body}"
-    ---
-    Pergunta: Este comentário está fornecendo conselho direto, apoio emocional, uma perspectiva relevante ou uma pergunta construtiva em resposta direta ao conteúdo e desabafo do post original? Foque em diferenciar conselhos/apoio de mensagens automáticas de MOD, perguntas genéricas não relacionadas ao desabafo (ex: "O que aconteceu?"), ou meta-comentários sobre o Reddit.
-
-    Responda APENAS com "Sim" ou "Não".
-    """
+    verification_prompt = _VERIFY_PROMPT_TMPL.format(title=post_title, body=truncated_post_body, comment=truncated_comment_body)
 
     try:
-        logger.debug(f"Sending verification prompt to LLM for comment: {comment_body[:60]}...")
+        logger.debug("Sending verification prompt to LLM for comment: {}...", comment_body[:60])
+        rate_limiter.acquire()
         response = client.chat.completions.create(
             model=LLM_NAME, # Use a cheaper/faster model if suitable for classification
             messages=[
@@ -120,21 +303,104 @@ def verify_comment_advice(post_title: str, post_body: str, comment_body: str) ->
         )
         verification_answer = response.choices[0].message.content.strip().lower()
 
-        logger.info(f"Received verification response: '{verification_answer}' for comment: {comment_body[:60]}...")
+        logger.info("Received verification response: '{}' for comment: {}...", verification_answer, comment_body[:60])
 
-        if verification_answer.startswith("sim"):
-            return True
-        elif verification_answer.startswith("não") or verification_answer.startswith("nao"):
-             return False
-        else:
-            logger.warning(f"Ambiguous verification response: '{verification_answer}'. Could not determine Yes/No.")
-            return None # Ambiguous answer
+        is_advice = _parse_verification_answer(verification_answer)
+        _cache_verification(cache_key, is_advice)
+        return is_advice
 
     except openai.APITimeoutError:
         logger.error(f"OpenAI API request timed out (verify_comment_advice).")
     except openai.APIError as e:
         logger.error(f"OpenAI API error (verify_comment_advice): {e}")
     except Exception as e:
-        logger.error(f"Error during comment verification LLM call: {e}", exc_info=True)
+        logger.opt(exception=True).error("Error during comment verification LLM call: {}", e)
+
+    return None # Return None if any error occurred
+
+def verify_comments_batch(post_title: str, post_body: str, comments: List[str]) -> List[Optional[bool]]:
+    """
+    Verifies all comments of a post in a single LLM call (see verify_comment_advice).
+    Comments with a cached answer are left out of the call.
+
+    Args:
+        post_title: Title of the original post.
+        post_body: Body of the original post.
+        comments: The comment texts to verify, in rank order.
+
+    Returns:
+        One True/False/None per comment, in the same order.
+    """
+    cache_keys = [_verification_key(post_title, post_body, comment_body) for comment_body in comments]
+    answers = [_get_cached_verification(key) for key in cache_keys]
+    missing = [i for i, answer in enumerate(answers) if answer is None]
+    if not missing:
+        return answers
+    if len(missing) < len(comments):
+        logger.debug("Using {} cached verifications; verifying {} comments.", len(comments) - len(missing), len(missing))
+
+    fresh_answers = _request_comment_verifications(post_title, post_body, [comments[i] for i in missing])
+    for i, answer in zip(missing, fresh_answers):
+        answers[i] = answer
+        _cache_verification(cache_keys[i], answer)
+    return answers
+
+def _request_comment_verifications(post_title: str, post_body: str, comments: List[str]) -> List[Optional[bool]]:
+    """
+    Sends one batch verification request for the given comments.
+
+    Returns:
+        One True/False/None per comment, in the same order; all None if the call fails
+        or the response does not contain exactly one answer per comment.
+    """
+    if not comments:
+        return []
+    if not client:
+        logger.error("LLM client (_request_comment_verifications) is not initialized.")
+        return [None] * len(comments)
+
+    # Same truncation limits as verify_comment_advice
+    max_comment_len = 500
+    max_post_body_len = 1000
+    truncated_post_body = post_body[:max_post_body_len] if post_body else ""
+    numbered_comments = "\n".join(
+        f'{i}. "{comment_body[:max_comment_len]}"' for i, comment_body in enumerate(comments, start=1)
+    )
+
+    verification_prompt = _VERIFY_BATCH_PROMPT_TMPL.format(
+        title=post_title, body=truncated_post_body, n_comments=len(comments), comments=numbered_comments
+    )
+
+    try:
+        logger.debug("Sending batch verification prompt to LLM for {} comments...", len(comments))
+        rate_limiter.acquire()
+        response = client.chat.completions.create(
+            model=LLM_NAME,
+            messages=[
+                {"role": "system", "content": "Você é um classificador de comentários. Analise cada comentário no contexto do post original e responda apenas 'Sim' ou 'Não' para cada um, em JSON."},
+                {"role": "user", "content": verification_prompt}
+            ],
+            max_tokens=20 + 10 * len(comments), # A short answer per comment
+            temperature=0.1, # Low temperature for consistent classification
+            n=1,
+            response_format={"type": "json_object"},
+        )
+        answers = json.loads(response.choices[0].message.content).get("respostas")
+
+        if not isinstance(answers, list) or len(answers) != len(comments):
+            logger.warning(f"Batch verification returned {answers!r}; expected {len(comments)} answers.")
+            return [None] * len(comments)
+
+        logger.info("Received batch verification response: {}", answers)
+        return [_parse_verification_answer(str(answer)) for answer in answers]
+
+    except openai.APITimeoutError:
+        logger.error(f"OpenAI API request timed out (verify_comments_batch).")
+    except openai.APIError as e:
+        logger.error(f"OpenAI API error (verify_comments_batch): {e}")
+    except (json.JSONDecodeError, AttributeError) as e:
+        logger.error(f"Could not parse batch verification response: {e}")
+    except Exception as e:
+        logger.opt(exception=True).error("Error during batch comment verification LLM call: {}", e)
 
-    return None # Return None if any error occurred
\ No newline at end of file
+    return [None] * len(comments)
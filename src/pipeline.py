@@ -1,162 +1,373 @@
+import asyncio
+import itertools
+import re
 import time
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
 from . import config, reddit_scraper, llm_interface, text_analyzer, database_cloud_sql
+import praw
 from loguru import logger
 
-# Delay between processing posts (in seconds)
-POST_PROCESSING_DELAY = 5
-# Delay between LLM calls within a single post's processing (in seconds)
-INTRA_POST_LLM_DELAY = 3 # Increase if hitting rate limits
+# Upper bound on the pause after an unexpected error (in seconds); the actual pause
+# follows Reddit's remaining quota (see _backoff_after_error).
+# Regular pacing is left to llm_interface.rate_limiter and PRAW's own rate limiting.
+MAX_BACKOFF_DELAY = 60
+
+# Number of posts whose main LLM advice is requested concurrently
+LLM_BATCH_SIZE = 8
+# Threads fetching Reddit comments in the background while posts are processed
+COMMENT_FETCH_WORKERS = 4
+# Threads verifying posts' comments (I/O-bound LLM calls) in parallel
+POST_WORKERS = 8
+# Cosine similarity above which new advice is flagged as repeating an earlier response
+NEAR_DUPLICATE_THRESHOLD = 0.95
+
+
+def _ratelimit_delay(error: Exception) -> Optional[float]:
+    """Seconds Reddit asked us to wait in a RATELIMIT API error, if that is what `error` is."""
+    if not isinstance(error, praw.exceptions.RedditAPIException):
+        return None
+    for item in error.items:
+        if item.error_type == "RATELIMIT":
+            match = re.search(r"(\d+) (minute|second)", item.message)
+            if match:
+                return int(match.group(1)) * (60 if match.group(2) == "minute" else 1)
+    return None
+
+
+def _adaptive_delay(reddit: praw.Reddit) -> float:
+    """Spreads the remaining Reddit quota evenly over the time left in the rate-limit window."""
+    limits = reddit.auth.limits
+    remaining, reset_timestamp = limits.get("remaining"), limits.get("reset_timestamp")
+    if remaining is None or reset_timestamp is None:
+        return 0.0 # No request made yet, so no quota information
+    return max(0.0, (reset_timestamp - time.time()) / max(remaining, 1))
+
+
+def _backoff_after_error(reddit: praw.Reddit, error: Exception):
+    """Pauses only as long as Reddit's rate limit requires (often not at all) after an error."""
+    delay = _ratelimit_delay(error)
+    if delay is None:
+        delay = _adaptive_delay(reddit)
+    delay = min(delay, MAX_BACKOFF_DELAY)
+    if delay > 0:
+        logger.info(f"Backing off for {delay:.1f}s after error.")
+        time.sleep(delay)
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yields consecutive lists of up to `size` items, consuming the iterable lazily."""
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def _flag_repeated_advice(response_index: text_analyzer.EmbeddingIndex, batch_data: List[dict], llm_results: List[Optional[dict]]):
+    """
+    Warns about new LLM advice that is a near-duplicate of advice given earlier in this run,
+    then adds the batch's advice to the index.
+    """
+    responses = [llm_op_result['response'] if llm_op_result else "" for llm_op_result in llm_results]
+    try:
+        nearest = response_index.nearest_many(responses, k=1, add=True)
+    except Exception as e:
+        logger.warning(f"Near-duplicate check failed for this batch: {e}")
+        return
+    for post_data, matches in zip(batch_data, nearest):
+        if matches and matches[0][1] >= NEAR_DUPLICATE_THRESHOLD:
+            logger.warning(
+                "LLM advice for post {} nearly repeats an earlier response in this run (cosine {:.3f}).",
+                post_data['post_id'], matches[0][1],
+            )
+
+
+def _prepare_post(submission, post_data: dict, llm_op_result: Optional[dict], top_comments_future: Future) -> Optional[dict]:
+    """
+    Verifies one post's (prefetched) top comments and collects its rows; similarity
+    scores are filled in later for the whole batch by _score_similarities.
+    Makes no DB writes, so it can run in a worker thread.
+
+    Returns:
+        A dict with 'post_data', 'llm_op_result' and 'comment_records', or None if the
+        post's main LLM advice is missing.
+    """
+    post_id = submission.id
+    post_title = post_data['post_title']
+    post_body = post_data['post_body']
+    logger.info("--- Processing Post ID: {} | Title: {}... ---", post_id, submission.title[:60])
+
+    if not llm_op_result:
+        logger.error(f"Failed to get LLM advice for post {post_id}. Cannot proceed with comments for this post.")
+        # Insert core post data even if LLM fails? Or skip? Let's skip for now.
+        return None
+
+    top_comments = top_comments_future.result()
+    comment_records = []
+    if not top_comments:
+        logger.warning(f"No suitable top comments found for post {post_id}. Storing post data only.")
+    else:
+        # --- Process Each Top Comment ---
+        logger.info("Processing {} comments for post {}...", len(top_comments), post_id)
+
+        # 5. Verify all Comments using a single LLM call
+        logger.debug("Verifying {} comments for post {}...", len(top_comments), post_id)
+        verifications = llm_interface.verify_comments_batch(
+            post_title, post_body, [comment.body for comment in top_comments]
+        )
+
+        for rank, (comment, is_actual_advice) in enumerate(zip(top_comments, verifications), start=1):
+            if is_actual_advice is None:
+                 logger.warning(f"Verification failed or was ambiguous for comment {comment.id}.")
+
+            # 6. Collect Comment Data (similarity is scored per batch, then stored per post)
+            comment_records.append({
+                'post_id': post_id,
+                'comment_id': comment.id,
+                'comment_body': comment.body,
+                'comment_score': comment.score,
+                'comment_rank': rank,
+                'is_actual_advice': is_actual_advice,
+                'similarity_score': None
+            })
+
+    return {'post_data': post_data, 'llm_op_result': llm_op_result, 'comment_records': comment_records}
+
+
+def _score_similarities(prepared_posts: List[dict]):
+    """Scores every comment of the batch against its post's main LLM advice with one batched encode."""
+    records = [record for prepared in prepared_posts for record in prepared['comment_records']]
+    if not records:
+        return
+    advice_texts = [
+        prepared['llm_op_result']['response']
+        for prepared in prepared_posts for _ in prepared['comment_records']
+    ]
+    logger.info(f"Calculating similarity for {len(records)} comments...")
+    similarity_scores = text_analyzer.calculate_similarity_batch(
+        [record['comment_body'] for record in records], advice_texts
+    )
+    for record, similarity_score in zip(records, similarity_scores):
+        if similarity_score is None:
+             logger.warning(f"Could not calculate similarity for comment {record['comment_id']}.")
+        record['similarity_score'] = similarity_score
+
+
+def _store_post(prepared: dict, session):
+    """Stores one prepared post, its main LLM advice and its comments in its own savepoint."""
+    post_data = prepared['post_data']
+    llm_op_result = prepared['llm_op_result']
+    comment_records = prepared['comment_records']
+    post_id = post_data['post_id']
+
+    # A failing post rolls back to its savepoint without losing the rest of the batch
+    with session.begin_nested():
+        # Insert LLM OP data (prompt + response) before its comments
+        database_cloud_sql.insert_post_and_llm(post_data, llm_op_result['prompt'], llm_op_result['response'], session=session)
+        database_cloud_sql.insert_post_comments_bulk(comment_records, session=session)
+
+    logger.success(f"Finished processing post {post_id} with {len(comment_records)} comments.")
+
+
+def _store_batch(prepared_posts: List[dict], session) -> bool:
+    """
+    Stores a whole batch with one executemany for the posts + LLM data and one for the comments.
+
+    Returns:
+        False if the batch was rolled back to its savepoint; the caller then falls back to
+        _store_post per post, so one bad row does not cost the whole batch.
+    """
+    posts = [
+        {**prepared['post_data'], 'input_prompt': prepared['llm_op_result']['prompt'], 'llm_response': prepared['llm_op_result']['response']}
+        for prepared in prepared_posts
+    ]
+    comment_records = [record for prepared in prepared_posts for record in prepared['comment_records']]
+    try:
+        with session.begin_nested():
+            database_cloud_sql.insert_posts_and_llm_bulk(posts, session=session)
+            database_cloud_sql.insert_post_comments_bulk(comment_records, session=session)
+    except Exception as e:
+        logger.warning(f"Bulk insert of {len(posts)} posts failed, storing them one by one: {e}")
+        return False
+
+    for prepared in prepared_posts:
+        logger.success(f"Finished processing post {prepared['post_data']['post_id']} with {len(prepared['comment_records'])} comments.")
+    return True
+
 
 def run_pipeline():
     """Runs the main processing pipeline."""
     logger.info("Starting LLM Desabafos Analyzer pipeline run...")
 
     # --- Initialization ---
-    conn = None
     try:
         reddit = reddit_scraper.get_reddit_instance()
-        #conn = database.get_db_connection()
-        database_cloud_sql.get_engine() 
+        database_cloud_sql.get_engine()
+        database_cloud_sql.warm_up_pool()
         database_cloud_sql.create_tables()
         if not llm_interface.client:
              raise ConnectionError("LLM Client failed to initialize.")
-        if not text_analyzer.similarity_model:
+        if not text_analyzer.get_model(): # Loads it now rather than in the first batch
             raise RuntimeError("Similarity model failed to load.")
     except Exception as e:
         logger.error(f"Pipeline initialization failed: {e}")
-        if conn: conn.close()
         return
 
-    # --- Fetch Posts ---
+    # This run's advice so far, which each batch's new responses are compared against.
+    # It grows from the responses already encoded for the check, so nothing is re-encoded.
+    response_index = text_analyzer.EmbeddingIndex()
+
+    # --- Fetch Posts (lazily: listing pages are requested as batches are pulled) ---
     posts = reddit_scraper.get_subreddit_posts(reddit, config.SUBREDDIT_NAME, config.POST_LIMIT)
-    if not posts:
-        logger.warning("No posts fetched. Exiting pipeline.")
-        if conn: conn.close()
-        return
 
-    # --- Process Posts ---
+    # --- Process Posts (in batches of LLM_BATCH_SIZE) ---
     processed_count = 0
     skipped_count = 0
     error_count = 0
-    for submission in posts:
-        post_id = submission.id
-        main_llm_advice_response = None # Store the main advice for similarity calculation
-        llm_call_successful = False # Track if main LLM call worked
+    interrupted = False
+
+    # Top Comments are fetched in the background: the workers fetch the next batch's
+    # comments while this thread waits on LLM calls and writes to the DB.
+    # PRAW backs off on Reddit's rate-limit headers itself, so no sleeps between fetches.
+    comment_pool = ThreadPoolExecutor(max_workers=COMMENT_FETCH_WORKERS, thread_name_prefix="comments")
+    post_pool = ThreadPoolExecutor(max_workers=POST_WORKERS, thread_name_prefix="posts")
+    comment_futures = {}
+
+    def pending_batches():
+        """Yields batches of unprocessed posts as the listing streams in, queueing their comment fetches."""
+        nonlocal skipped_count
+        for fetched in _chunked(posts, LLM_BATCH_SIZE):
+            # 1. Check if already processed (one query per batch), so no LLM calls are spent on known posts
+            already_processed = database_cloud_sql.filter_processed_post_ids([submission.id for submission in fetched])
+            batch = []
+            for submission in fetched:
+                if submission.id in already_processed:
+                    logger.info("Post {} core data already exists. Skipping.", submission.id)
+                    skipped_count += 1
+                    continue
+                batch.append(submission)
+                # 2. Queue the post's Top Comments fetch
+                # (by id: the workers fetch through their own Reddit instances, as PRAW is not thread-safe)
+                comment_futures[submission.id] = comment_pool.submit(
+                    reddit_scraper.get_top_comments_by_id, submission.id, limit=reddit_scraper.MAX_COMMENTS_TO_FETCH
+                )
+            if batch:
+                yield batch
+
+    batches = pending_batches()
+    next_batch = next(batches, None)
+    if next_batch is None and not skipped_count:
+        logger.warning("No posts fetched. Exiting pipeline.")
+    batch_number = 0
+    while next_batch is not None:
+        batch, next_batch = next_batch, None
+        batch_number += 1
+
+        try:
+            # Pull the following batch now, so its comment fetches overlap this batch's work
+            next_batch = next(batches, None)
+        except KeyboardInterrupt:
+            logger.warning("Pipeline interrupted by user.")
+            break
+        except Exception as e:
+            # The listing generator is finished after raising: this batch is still processed, then the run ends
+            logger.opt(exception=True).error("An unexpected error occurred fetching the posts after batch {}: {}", batch_number, e)
+            _backoff_after_error(reddit, e)
 
         try:
-            logger.info(f"--- Processing Post ID: {post_id} | Title: {submission.title[:60]}... ---")
-
-            # 1. Check if already processed (basic check, might need refinement)
-            if database.check_post_processed(conn, post_id):
-                logger.info(f"Post {post_id} core data already exists. Skipping.")
-                skipped_count += 1
-                continue # Skip entire post processing if base record exists
-
-            # 2. Extract Post Data
-            post_data = reddit_scraper.extract_post_data(submission)
-            post_title = post_data['post_title']
-            post_body = post_data['post_body']
-
-            # 3. Get Main LLM Advice for the Original Post
-            logger.info(f"Getting main LLM advice for OP (Post {post_id})...")
-            llm_op_result = llm_interface.get_llm_response(post_title, post_body)
-            time.sleep(INTRA_POST_LLM_DELAY) # Delay after LLM call
-
-            if llm_op_result:
-                # Check if LLM call was successful
-                main_llm_advice_response = llm_op_result['response']
-                llm_call_successful = True
-                # Insert LLM OP data (prompt + response) immediately after getting it
-                database.insert_processed_post(conn, post_data)
-                database.insert_llm_data(conn, post_id, llm_op_result['prompt'], main_llm_advice_response)
-                logger.info(f"Main LLM advice for post {post_id} stored successfully.")
-            else:
-                logger.error(f"Failed to get LLM advice for post {post_id}. Cannot proceed with comments for this post.")
-                # Insert core post data even if LLM fails? Or skip? Let's skip for now.
+            # 3. Extract Post Data
+            batch_data = [reddit_scraper.extract_post_data(submission) for submission in batch]
+
+            # 4. Get Main LLM Advice for every post in the batch concurrently
+            logger.info(f"Getting main LLM advice for {len(batch)} posts...")
+            llm_results = asyncio.run(llm_interface.get_llm_responses_async(
+                [(post_data['post_title'], post_data['post_body']) for post_data in batch_data]
+            ))
+            _flag_repeated_advice(response_index, batch_data, llm_results)
+        except KeyboardInterrupt:
+            logger.warning("Pipeline interrupted by user.")
+            break
+        except Exception as e:
+            logger.opt(exception=True).error("An unexpected error occurred preparing batch {}: {}", batch_number, e)
+            error_count += len(batch)
+            for submission in batch:
+                comment_futures.pop(submission.id).cancel() # Drop the failed batch's pending comment fetches
+            _backoff_after_error(reddit, e)
+            continue
+
+        # 5. Verify each post's comments and collect its rows, POST_WORKERS posts at a time
+        prepare_futures = [
+            post_pool.submit(_prepare_post, submission, post_data, llm_op_result, comment_futures.pop(submission.id))
+            for submission, post_data, llm_op_result in zip(batch, batch_data, llm_results)
+        ]
+        prepared_posts = []
+        for submission, prepare_future in zip(batch, prepare_futures):
+            post_id = submission.id
+            try:
+                prepared = prepare_future.result()
+                if prepared is None:
+                    error_count += 1
+                else:
+                    prepared_posts.append(prepared)
+
+            except KeyboardInterrupt:
+                logger.warning("Pipeline interrupted by user.")
+                interrupted = True
+                break
+            except Exception as e:
+                logger.opt(exception=True).error("An unexpected error occurred processing post {}: {}", post_id, e)
                 error_count += 1
-                
-                time.sleep(POST_PROCESSING_DELAY) # Wait before next post
-                continue
-
-            # 4. Get Top Comments (if main LLM call was successful)
-            logger.info(f"Fetching top comments for post {post_id}...")
-            top_comments = reddit_scraper.get_top_comments(submission, limit=reddit_scraper.MAX_COMMENTS_TO_FETCH)
-            time.sleep(1) # Small delay after Reddit API call
-
-            if not top_comments:
-                logger.warning(f"No suitable top comments found for post {post_id}. Storing post data only.")
-                # Insert core post data even if no comments found
-                #database.insert_processed_post(conn, post_data)
-                processed_count += 1 # Count as processed (even without comments)
-                time.sleep(POST_PROCESSING_DELAY) # Wait before next post
-                continue
-
-            # --- Process Each Top Comment ---
-            logger.info(f"Processing {len(top_comments)} comments for post {post_id}...")
-            comments_processed_count = 0
-            for rank, comment in enumerate(top_comments, start=1):
-                comment_id = comment.id
-                comment_body = comment.body
-                comment_score = comment.score
-                is_actual_advice = None
-                similarity_score = None
-
-                # 5. Verify Comment using LLM
-                logger.debug(f"Verifying comment rank {rank} (ID: {comment_id}) for post {post_id}...")
-                is_actual_advice = llm_interface.verify_comment_advice(post_title, post_body, comment_body)
-                time.sleep(INTRA_POST_LLM_DELAY) # Delay after *each* verification LLM call
-
-                if is_actual_advice is None:
-                     logger.warning(f"Verification failed or was ambiguous for comment {comment_id}.")
-
-                # 6. Calculate Similarity (e.g., only for Rank 1 comment vs main LLM advice)
-                if rank == 1 and main_llm_advice_response:
-                    logger.debug(f"Calculating similarity for rank 1 comment {comment_id}...")
-                    similarity_score = text_analyzer.calculate_similarity(
-                        comment_body,
-                        main_llm_advice_response
-                    )
-                    if similarity_score is None:
-                         logger.warning(f"Could not calculate similarity for comment {comment_id}.")
-
-                # 7. Store Comment Data
-                comment_data = {
-                    'post_id': post_id,
-                    'comment_id': comment_id,
-                    'comment_body': comment_body,
-                    'comment_score': comment_score,
-                    'comment_rank': rank,
-                    'is_actual_advice': is_actual_advice,
-                    'similarity_score': similarity_score
-                }
-                database.insert_post_comment(conn, comment_data)
-                comments_processed_count += 1
-
-
-            # 8. Store Core Post Data (after processing comments)
-            # This ensures the post record exists before comments with FK are inserted
-            # (Correction: Moved insert_llm_data earlier, insert post data here)
-            database.insert_processed_post(conn, post_data)
-            processed_count += 1
-            logger.success(f"Finished processing post {post_id} with {comments_processed_count} comments.")
-
-            # Delay before processing the next post
-            time.sleep(POST_PROCESSING_DELAY)
+                _backoff_after_error(reddit, e)
+
+        if interrupted:
+            break
 
+        processed_before = processed_count
+        try:
+            # 6. Calculate Similarity for all comments of the batch at once
+            _score_similarities(prepared_posts)
         except KeyboardInterrupt:
             logger.warning("Pipeline interrupted by user.")
             break
+
+        # 7. Store the batch's posts with their comments in one transaction (one commit)
+        try:
+            with database_cloud_sql.get_db_session() as session:
+                try:
+                    stored_in_bulk = _store_batch(prepared_posts, session)
+                except KeyboardInterrupt:
+                    logger.warning("Pipeline interrupted by user.")
+                    interrupted = True
+                    stored_in_bulk = False
+                if stored_in_bulk:
+                    processed_count += len(prepared_posts)
+                for prepared in ([] if stored_in_bulk or interrupted else prepared_posts):
+                    post_id = prepared['post_data']['post_id']
+                    try:
+                        _store_post(prepared, session)
+                        processed_count += 1
+                    except KeyboardInterrupt:
+                        logger.warning("Pipeline interrupted by user.")
+                        interrupted = True
+                        break # Still commits the posts stored so far
+                    except Exception as e:
+                        logger.opt(exception=True).error("An unexpected error occurred storing post {}: {}", post_id, e)
+                        error_count += 1
         except Exception as e:
-            logger.error(f"An unexpected error occurred processing post {post_id}: {e}", exc_info=True)
-            error_count += 1
-            time.sleep(POST_PROCESSING_DELAY * 2) # Longer delay after an error
+            # The commit itself failed: none of the batch's posts were stored
+            logger.opt(exception=True).error("An unexpected error occurred committing batch {}: {}", batch_number, e)
+            error_count += processed_count - processed_before
+            processed_count = processed_before
+            _backoff_after_error(reddit, e)
+
+        if interrupted:
+            break
 
     # --- Cleanup ---
-    if conn:
-        conn.close()
-        logger.info("Database connection closed.")
+    post_pool.shutdown(wait=False, cancel_futures=True)
+    comment_pool.shutdown(wait=False, cancel_futures=True)
+    database_cloud_sql.close_connection_pool()
 
     logger.info(f"Pipeline run finished. Posts processed: {processed_count}, Posts skipped: {skipped_count}, Post errors: {error_count}")
 
@@ -167,7 +378,8 @@ if __name__ == '__main__':
     log_file_path = log_dir / "pipeline_{time}.log"
 
     logger.remove()
-    logger.add(log_file_path, rotation="1 day", retention="7 days", level=config.LOG_LEVEL, backtrace=True, diagnose=True) # Enhanced logging
+    # diagnose=False: tracebacks without per-frame variable dumps (cheaper, and keeps secrets out of the logs)
+    logger.add(log_file_path, rotation="1 day", retention="7 days", level=config.LOG_LEVEL, backtrace=True, diagnose=False)
     logger.add(sys.stderr, level="INFO") # Keep console INFO level clean
 
     run_pipeline()
\ No newline at end of file
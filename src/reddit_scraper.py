@@ -2,12 +2,20 @@ import praw
 import prawcore # Import prawcore for specific exceptions
 from . import config
 from loguru import logger
-import datetime
-from typing import List, Optional
+import heapq
+import itertools
+import threading
+from typing import Iterator, List, Optional
 import time
 # Max comments to fetch and consider per post
 MAX_COMMENTS_TO_FETCH = 5
 
+def _to_epoch(ts: Optional[float]) -> Optional[int]:
+    """Truncates a PRAW epoch timestamp (float seconds, UTC) to whole seconds."""
+    if ts is None:
+        return None
+    return int(ts)
+
 def get_reddit_instance():
     """Initializes and returns a PRAW Reddit instance."""
     try:
@@ -23,31 +31,62 @@ def get_reddit_instance():
         logger.error(f"Failed to create PRAW Reddit instance: {e}")
         raise
 
-def get_subreddit_posts(reddit: praw.Reddit, subreddit_name: str, limit: int):
-    """Fetches recent posts from a specified subreddit."""
+# PRAW is not thread-safe (its session and rate limiter are unsynchronized): each
+# worker thread gets its own Reddit instance instead of sharing the main thread's
+_thread_local = threading.local()
+
+def get_thread_reddit_instance() -> praw.Reddit:
+    """Returns the calling thread's own PRAW Reddit instance, creating it on first use."""
+    reddit = getattr(_thread_local, "reddit", None)
+    if reddit is None:
+        reddit = _thread_local.reddit = get_reddit_instance()
+    return reddit
+
+def get_subreddit_posts(reddit: praw.Reddit, subreddit_name: str, limit: int) -> Iterator[praw.models.Submission]:
+    """
+    Yields recent posts (last 24 hours) from a specified subreddit.
+
+    Listing pages are requested lazily as the caller iterates, so processing can
+    start before the whole listing is downloaded.
+    """
+    # Filter posts to only include those from the last 24 hours
+    twenty_four_hours_ago = time.time() - 24 * 60 * 60  # 24 hours in seconds
+    fetched = 0
     try:
         subreddit = reddit.subreddit(subreddit_name)
-        all_posts = list(subreddit.new(limit=limit*3))  # Fetch more to ensure we get enough recent posts
-        # Filter posts to only include those from the last 24 hours
-        twenty_four_hours_ago = time.time() - 24 * 60 * 60  # 24 hours in seconds
-        posts = [submission for submission in all_posts if submission.created_utc >= twenty_four_hours_ago]
-
+        # The 'new' listing is sorted newest first, so stop at the first post older than
+        # the cutoff instead of filtering a fixed limit*3 posts (limit=None: pages are
+        # only requested until one of the two stops is reached)
+        recent_posts = itertools.takewhile(
+            lambda submission: submission.created_utc >= twenty_four_hours_ago,
+            subreddit.new(limit=None),
+        )
         # Limit to the specified number of posts
-        posts = posts[:limit]
-        # Log the number of posts fetched
-        if len(posts) < limit:
-            logger.warning(f"Fetched only {len(posts)} posts from r/{subreddit_name} instead of {limit}.")
-        else:
-            logger.info(f"Fetched {limit} posts from r/{subreddit_name}.")
-        return posts
+        for submission in itertools.islice(recent_posts, limit):
+            fetched += 1
+            yield submission
     except Exception as e:
         logger.error(f"Failed to fetch posts from r/{subreddit_name}: {e}")
-        return []
+        return
+
+    # Log the number of posts fetched
+    if fetched < limit:
+        logger.warning(f"Fetched only {fetched} posts from r/{subreddit_name} instead of {limit}.")
+    else:
+        logger.info(f"Fetched {limit} posts from r/{subreddit_name}.")
+
+def _is_candidate_comment(comment) -> bool:
+    """True for regular user comments (not stickied, deleted/removed or mod/admin)."""
+    return isinstance(comment, praw.models.Comment) and \
+        not comment.stickied and \
+        comment.author is not None and \
+        comment.body not in ('[deleted]', '[removed]') and \
+        comment.distinguished not in ('moderator', 'admin') # Exclude mod/admin comments explicitly
 
 # --- Renamed and modified from get_top_comment ---
 def get_top_comments(submission: praw.models.Submission, limit: int = MAX_COMMENTS_TO_FETCH) -> List[praw.models.Comment]:
     """
-    Finds the most upvoted, non-stickied, non-deleted, non-mod comments
+    Finds the most upvoted, non-stickied, non-deleted, non-mod top-level comments
     in a submission, up to a specified limit.
     """
     top_comments = []
@@ -55,35 +94,32 @@ def get_top_comments(submission: praw.models.Submission, limit: int = MAX_COMMEN
         # Sort comments by 'score' (PRAW might internally use 'top' or requires manual sort after fetch)
         # It's safer to fetch and sort manually
         submission.comment_sort = "top" # Suggest sorting, but PRAW handling varies
-        submission.comments.replace_more(limit=0) # Load top-level comments
-
-        candidate_comments = []
-        for comment in submission.comments.list():
-             # Filter out unwanted comments
-             if isinstance(comment, praw.models.Comment) and \
-               not comment.stickied and \
-               comment.author is not None and \
-               comment.body not in ('[deleted]', '[removed]') and \
-               comment.distinguished not in ('moderator', 'admin'): # Exclude mod/admin comments explicitly
-                 candidate_comments.append(comment)
 
-        # Sort the candidates by score descending
-        candidate_comments.sort(key=lambda c: c.score, reverse=True)
-
-        # Take the top 'limit' comments
-        top_comments = candidate_comments[:limit]
+        # Top-level comments only: iterating the CommentForest skips flattening the reply
+        # tree, and leftover MoreComments stubs are dropped by _is_candidate_comment
+        # (so no replace_more is needed either).
+        # Keep only the 'limit' highest-scoring candidates (O(n log k), no full sort)
+        top_comments = heapq.nlargest(
+            limit,
+            (comment for comment in submission.comments if _is_candidate_comment(comment)),
+            key=lambda c: c.score,
+        )
 
-        logger.info(f"Found {len(top_comments)} top comments for post {submission.id} (limit: {limit})")
+        logger.info("Found {} top comments for post {} (limit: {})", len(top_comments), submission.id, limit)
         return top_comments
 
     except prawcore.exceptions.NotFound:
          logger.warning(f"Post {submission.id} might have been deleted, comments not accessible.")
          return []
     except Exception as e:
-        logger.error(f"Error fetching comments for post {submission.id}: {e}", exc_info=True)
+        logger.opt(exception=True).error("Error fetching comments for post {}: {}", submission.id, e)
         return [] # Return empty list on error
 
 
+def get_top_comments_by_id(post_id: str, limit: int = MAX_COMMENTS_TO_FETCH) -> List[praw.models.Comment]:
+    """get_top_comments for worker threads: loads the post through the thread's own Reddit instance."""
+    return get_top_comments(get_thread_reddit_instance().submission(id=post_id), limit=limit)
+
 def extract_post_data(submission: praw.models.Submission) -> dict:
     """Extracts relevant data from a PRAW submission object."""
     return {
@@ -91,8 +127,8 @@ def extract_post_data(submission: praw.models.Submission) -> dict:
         "post_url": f"https://www.reddit.com{submission.permalink}", # Ensure full URL
         "post_title": submission.title,
         "post_body": submission.selftext,
-        # Ensure UTC timezone awareness
-        "created_utc": datetime.datetime.fromtimestamp(submission.created_utc, tz=datetime.timezone.utc),
+        # Epoch seconds (UTC); the databases store/convert it themselves
+        "created_utc": _to_epoch(submission.created_utc),
     }
 
 # Removed extract_comment_data as it's handled differently now
\ No newline at end of file
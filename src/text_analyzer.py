@@ -1,44 +1,284 @@
-from sentence_transformers import SentenceTransformer, util
-from . import config
+import os
+import functools
+import weakref
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+
+# Encoding runs from worker threads; HF tokenizers' own thread pool would only contend with them
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+from sentence_transformers import SentenceTransformer
+from . import config, embedding_cache
 from loguru import logger
 import torch # Or tensorflow, depending on your installation
 
-# Load the sentence transformer model globally for efficiency
-# This might take a few seconds the first time it's run
-try:
-    # Check for GPU availability
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    logger.info(f"Using device: {device} for sentence transformer model.")
-    similarity_model = SentenceTransformer(config.SIMILARITY_MODEL, device=device)
-    logger.info(f"Sentence transformer model '{config.SIMILARITY_MODEL}' loaded successfully.")
-except Exception as e:
-    logger.error(f"Failed to load sentence transformer model '{config.SIMILARITY_MODEL}': {e}")
-    similarity_model = None
+# Texts encoded per forward pass
+ENCODE_BATCH_SIZE = 64
+# Rough characters per token (Portuguese/English), for pre-truncating long texts
+CHARS_PER_TOKEN = 6
+# Texts shorter than this (after stripping) are scored 0.0 without encoding them
+MIN_TEXT_CHARS = 5
+# Pair scores remembered by calculate_similarity
+SIMILARITY_CACHE_SIZE = 1024
+# On CPU, encode calls with at least this many texts are spread over a pool of worker processes
+MULTI_PROCESS_MIN_TEXTS = 16
+# Texts per chunk handed to each worker process
+MULTI_PROCESS_BATCH_SIZE = 32
+# Upper bound on encoding worker processes (each holds a full copy of the model)
+MAX_ENCODE_PROCESSES = 4
+
+def _reduce_precision(model: SentenceTransformer, device: str) -> Tuple[SentenceTransformer, str]:
+    """
+    Runs the encoder in FP16 on CUDA and, if SIMILARITY_INT8 is set, with dynamic int8
+    Linear layers on CPU (otherwise CPU stays FP32). FP16 barely changes the embeddings;
+    int8 quantization shifts cosine scores noticeably more, trading some accuracy for CPU
+    speed, so it is opt-in to keep stored similarity_score values comparable across runs.
+    The precision mode is part of the embedding cache key (see _cache_key), so vectors
+    from different modes are never mixed.
+
+    Returns:
+        The model and its precision mode: "fp16", "int8" or "fp32" (if the reduction failed).
+    """
+    try:
+        if device == 'cuda':
+            model = model.half()
+            logger.info("Sentence transformer model converted to FP16.")
+            return model, "fp16"
+        if not config.SIMILARITY_INT8:
+            return model, "fp32"
+        transformer = model[0] # The Transformer module wrapping the HF model
+        transformer.auto_model = torch.quantization.quantize_dynamic(
+            transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        logger.info("Sentence transformer model quantized to int8 (dynamic, Linear layers).")
+        return model, "int8"
+    except Exception as e:
+        logger.warning(f"Could not reduce model precision, keeping FP32: {e}")
+    return model, "fp32"
+
+# Precision mode of the loaded model, set by get_model()
+_precision: Optional[str] = None
+
+@functools.cache
+def get_model() -> Optional[SentenceTransformer]:
+    """
+    Loads the sentence transformer model on first use (a few seconds), then returns the same
+    instance. Importing this module stays cheap, and worker processes forked before the
+    first call do not inherit a CUDA context.
+
+    Returns:
+        The model, or None if it failed to load.
+    """
+    global _precision
+    try:
+        # Check for GPU availability
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        logger.info(f"Using device: {device} for sentence transformer model.")
+        model = SentenceTransformer(config.SIMILARITY_MODEL, device=device)
+        logger.info(f"Sentence transformer model '{config.SIMILARITY_MODEL}' loaded successfully.")
+    except Exception as e:
+        logger.error(f"Failed to load sentence transformer model '{config.SIMILARITY_MODEL}': {e}")
+        return None
+    model, _precision = _reduce_precision(model, device)
+    return model
+
+def _cache_key() -> str:
+    """Embedding cache key for the loaded model: its name plus precision mode."""
+    get_model()
+    return f"{config.SIMILARITY_MODEL}@{_precision}"
+
+def _max_chars(model: SentenceTransformer) -> int:
+    """
+    The model truncates to max_seq_length tokens anyway; cutting the text first spares
+    the tokenizer from processing the (possibly very long) remainder.
+    """
+    return (model.max_seq_length or 512) * CHARS_PER_TOKEN
+
+_process_pool = None
+
+def _encode_process_count() -> int:
+    """CPU cores this process may run on (not the host's count, e.g. on Cloud Run), capped at MAX_ENCODE_PROCESSES."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError: # Not available on macOS/Windows
+        cores = os.cpu_count() or 1
+    return max(1, min(cores, MAX_ENCODE_PROCESSES))
+
+def _get_process_pool() -> dict:
+    """Starts the CPU worker processes on first use; they are stopped when the model is collected or at exit."""
+    global _process_pool
+    if _process_pool is None:
+        model = get_model()
+        # Spawned workers read OMP_NUM_THREADS when torch starts: one intra-op thread per
+        # worker, so N workers use N cores instead of each contending for all of them
+        previous_threads = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = "1"
+        try:
+            _process_pool = model.start_multi_process_pool(['cpu'] * _encode_process_count())
+        finally:
+            if previous_threads is None:
+                del os.environ["OMP_NUM_THREADS"]
+            else:
+                os.environ["OMP_NUM_THREADS"] = previous_threads
+        weakref.finalize(model, SentenceTransformer.stop_multi_process_pool, _process_pool)
+        logger.info(f"Started {len(_process_pool['processes'])} encoding worker processes.")
+    return _process_pool
+
+def _encode_multi_process(texts: List[str]) -> np.ndarray:
+    """Encodes texts across all CPU cores (one forward pass per worker process at a time)."""
+    embeddings = get_model().encode_multi_process(texts, _get_process_pool(), batch_size=MULTI_PROCESS_BATCH_SIZE)
+    # Normalized here: encode_multi_process has no normalize_embeddings before sentence-transformers 2.3
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+
+def encode(texts: List[str]) -> np.ndarray:
+    """Encodes texts in batched forward passes into L2-normalized embeddings (one row per text)."""
+    model = get_model()
+    max_chars = _max_chars(model)
+    texts = [text[:max_chars] for text in texts]
+    if model.device.type == 'cpu' and len(texts) >= MULTI_PROCESS_MIN_TEXTS and _encode_process_count() > 1:
+        return _encode_multi_process(texts)
+    # No autograd bookkeeping (graph or view tracking) for pure inference
+    with torch.inference_mode():
+        return model.encode(
+            texts, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True
+        )
+
+def calculate_similarity_batch(texts_a: List[str], texts_b: List[str]) -> List[Optional[float]]:
+    """
+    Calculates the cosine similarity of each (texts_a[i], texts_b[i]) pair, encoding
+    every distinct text of both lists in a single batched encode call.
+
+    Returns:
+        One score per pair (1.0 for texts equal up to case and surrounding whitespace,
+        0.0 where either text is shorter than MIN_TEXT_CHARS), or all None if encoding fails.
+    """
+    if not get_model():
+        logger.error("Similarity model not loaded. Cannot calculate similarity.")
+        return [None] * len(texts_a)
+
+    scores: List[Optional[float]] = [0.0] * len(texts_a)
+    pairs = [i for i, (text_a, text_b) in enumerate(zip(texts_a, texts_b)) if text_a and text_b]
+    if len(pairs) < len(texts_a):
+        logger.warning(f"{len(texts_a) - len(pairs)} text pairs have an empty side; scoring them 0.0.")
+
+    # Fast paths without the model: identical texts score 1.0, near-empty ones 0.0
+    to_encode = []
+    for i in pairs:
+        text_a, text_b = texts_a[i].strip().lower(), texts_b[i].strip().lower()
+        if text_a == text_b:
+            scores[i] = 1.0
+        elif len(text_a) >= MIN_TEXT_CHARS and len(text_b) >= MIN_TEXT_CHARS:
+            to_encode.append(i)
+    pairs = to_encode
+    if not pairs:
+        return scores
+
+    try:
+        # Each distinct text is encoded once (e.g. one LLM advice shared by all its comments)
+        unique_texts = list(dict.fromkeys([texts_a[i] for i in pairs] + [texts_b[i] for i in pairs]))
+        row_of = {text: row for row, text in enumerate(unique_texts)}
+        # Texts seen in earlier runs come from the persistent cache instead of the model
+        embeddings = embedding_cache.get_or_compute(unique_texts, encode, _cache_key())
+        embeddings_a = embeddings[[row_of[texts_a[i]] for i in pairs]]
+        embeddings_b = embeddings[[row_of[texts_b[i]] for i in pairs]]
+
+        # Normalized embeddings: the row-wise dot product is the cosine similarity
+        cosine_scores = (embeddings_a * embeddings_b).sum(axis=1)
+        for i, score in zip(pairs, cosine_scores):
+            # Clamp score between 0 and 1 (sometimes scores can be slightly outside due to float precision)
+            scores[i] = max(0.0, min(1.0, float(score)))
+        logger.debug("Calculated {} similarity scores from {} encoded texts.", len(pairs), len(unique_texts))
+        return scores
+
+    except Exception as e:
+        logger.error(f"Error calculating text similarities: {e}")
+        return [None] * len(texts_a)
+
+# LRU of (text1, text2) -> score for repeated calculate_similarity calls within a run
+_similarity_cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
 
 def calculate_similarity(text1: str, text2: str) -> float | None:
     """Calculates cosine similarity between two texts using sentence embeddings."""
-    if not similarity_model:
-        logger.error("Similarity model not loaded. Cannot calculate similarity.")
-        return None
     if not text1 or not text2:
         logger.warning("One or both texts are empty. Cannot calculate similarity.")
         return 0.0 # Or None, depending on how you want to handle empty inputs
 
-    try:
-        # Encode the texts into embeddings
-        embedding1 = similarity_model.encode(text1, convert_to_tensor=True)
-        embedding2 = similarity_model.encode(text2, convert_to_tensor=True)
+    key = (text1, text2)
+    if key in _similarity_cache:
+        _similarity_cache.move_to_end(key)
+        return _similarity_cache[key]
 
-        # Calculate cosine similarity
-        cosine_scores = util.pytorch_cos_sim(embedding1, embedding2)
-        similarity_score = cosine_scores.item() # Get the single score value
+    # Same path as the batched scores: one encode call (or cache hit), normalized dot product
+    similarity_score = calculate_similarity_batch([text1], [text2])[0]
+    if similarity_score is not None:
+        logger.debug("Calculated similarity score: {:.4f}", similarity_score)
+        # Failures (None) are not cached, so they are retried on the next call
+        _similarity_cache[key] = similarity_score
+        if len(_similarity_cache) > SIMILARITY_CACHE_SIZE:
+            _similarity_cache.popitem(last=False)
+    return similarity_score
 
-        # Clamp score between 0 and 1 (sometimes scores can be slightly outside due to float precision)
-        similarity_score = max(0.0, min(1.0, similarity_score))
+def cosine_similarity_matrix(embeddings_a: np.ndarray, embeddings_b: np.ndarray) -> np.ndarray:
+    """
+    Pairwise cosine similarities (rows of a x rows of b) of L2-normalized embeddings,
+    as a single float32 matrix product (multithreaded BLAS GEMM).
+    """
+    return np.asarray(embeddings_a, dtype=np.float32) @ np.asarray(embeddings_b, dtype=np.float32).T
 
-        logger.debug(f"Calculated similarity score: {similarity_score:.4f}")
-        return similarity_score
+class EmbeddingIndex:
+    """
+    Exact nearest-neighbour search over a growing set of texts (e.g. LLM responses),
+    for spotting near-duplicates. Embeddings are normalized, so one matrix-vector product
+    (BLAS, SIMD) scores every text by cosine similarity.
+    """
 
-    except Exception as e:
-        logger.error(f"Error calculating text similarity: {e}")
-        return None
\ No newline at end of file
+    def __init__(self, texts: Optional[List[str]] = None):
+        self.texts: List[str] = []
+        self.embeddings: Optional[np.ndarray] = None
+        if texts:
+            self._add(list(dict.fromkeys(text for text in texts if text)))
+            logger.info(f"Embedding index built over {len(self.texts)} texts.")
+
+    def _add(self, texts: List[str], embeddings: Optional[np.ndarray] = None):
+        """Appends texts (not yet indexed) with their embeddings, encoding them if not given."""
+        if not texts:
+            return
+        if embeddings is None:
+            embeddings = embedding_cache.get_or_compute(texts, encode, _cache_key())
+        self.texts.extend(texts)
+        self.embeddings = embeddings if self.embeddings is None else np.vstack([self.embeddings, embeddings])
+
+    def nearest(self, text: str, k: int = 5) -> List[Tuple[str, float]]:
+        """Returns up to k (indexed text, cosine similarity) pairs, most similar first."""
+        return self.nearest_many([text], k)[0]
+
+    def nearest_many(self, texts: List[str], k: int = 5, add: bool = False) -> List[List[Tuple[str, float]]]:
+        """
+        nearest() for several query texts, scored against the index in one matrix product.
+        With add=True the query texts are indexed afterwards, reusing their embeddings.
+        """
+        results: List[List[Tuple[str, float]]] = [[] for _ in texts]
+        queries = [i for i, text in enumerate(texts) if text]
+        if not queries:
+            return results
+        query_embeddings = embedding_cache.get_or_compute([texts[i] for i in queries], encode, _cache_key())
+        if self.embeddings is not None:
+            self._score(results, queries, query_embeddings, k)
+        if add:
+            known = set(self.texts)
+            new_rows = []
+            for row, i in enumerate(queries):
+                if texts[i] not in known:
+                    known.add(texts[i])
+                    new_rows.append(row)
+            self._add([texts[queries[row]] for row in new_rows], query_embeddings[new_rows])
+        return results
+
+    def _score(self, results: List[List[Tuple[str, float]]], queries: List[int], query_embeddings: np.ndarray, k: int):
+        """Fills results[i] with the top-k indexed texts for each query row."""
+        scores = cosine_similarity_matrix(query_embeddings, self.embeddings)
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k] # Unordered top-k per row in O(n)
+        for row, i in enumerate(queries):
+            row_top = top[row][np.argsort(-scores[row, top[row]])]
+            results[i] = [(self.texts[j], float(scores[row, j])) for j in row_top]